@@ -1,51 +1,228 @@
 # WiP assembler for Flapjacks.
 # (c) 2024 Martin Young.
 
-# Currently outputs fully linked binaries for address 0.
+# Outputs fully linked binaries for address 0, by default as one hex
+# word per line (.o); with -b as raw little-endian 16 bit words (.bin).
+# With -s a symbol map (.sym) is written alongside, one "address label"
+# line per label in address order.
+#
+# With -r it instead writes a relocatable object (.rel, see fj_obj.py)
+# for fj_ld to link. Code before any .org can then be placed anywhere.
+# Labels named by .global are exported; a file without any .global
+# exports all its labels. Labels used but not defined are left for the
+# linker.
+#
+# With -l a listing (.lst) is written too: a line per word giving its
+# address, value and the file:line it came from, with the source text
+# on the first word from each line and a line per label.
+#
+# With -z the image is written sparse: hex as for .o, but each segment
+# (the code before the first .org, and each .org's) starts with an
+# "@address" line and the gaps between them aren't filled in. Otherwise
+# gaps are filled with zeros. .orgs may go in any order as long as the
+# segments don't overlap.
+#
+# Operands that take a constant take an expression (see fj_expr.py),
+# over labels and names set by ".equ NAME, expression". Those using
+# labels, or names not yet set, are left to be worked out at link time,
+# except in operands of 4 bits or less, which have to be known there and
+# then.
+#
+# ".macro name a, b" starts a macro, running to ".endm", used as
+# "name x, y". In the lines of a macro \a and \b stand for what's given
+# for a and b, and \@ for a number different each time it is used, for
+# making labels unique.
+#
+# A br to a label that turns out to be out of range is lengthened into
+# a const/jp sequence through a scratch register, r0 unless a
+# ".scratch rN" line says otherwise (".scratch none" makes it an error
+# instead). The scratch register is clobbered on the long path only.
+#
+# With -j N the files are assembled across N processes. Messages still
+# come out in file order, and the exit status is non-zero if any file
+# failed.
 
+import io
+import re
 import sys
+import contextlib
+import multiprocessing
+from array import array
+
+import bisect
+
+from fj_obj import apply_reloc, branch_delta, in_branch_range, write_object
+from fj_expr import ExprError, Undefined, canonical, evaluate, names
 
 def work():
     filenames = []
-    for arg in sys.argv[1:]:
-        if arg[0]=='-':
+    binary = False
+    symmap = False
+    reloc = False
+    sparse = False
+    listing = False
+    jobs = 1
+    args = sys.argv[1:]
+    while args != []:
+        arg = args.pop(0)
+        if arg == "-b":
+            binary = True
+        elif arg == "-s":
+            symmap = True
+        elif arg == "-r":
+            reloc = True
+        elif arg == "-z":
+            sparse = True
+        elif arg == "-l":
+            listing = True
+        elif arg == "-j":
+            if args == []:
+                print(f"Flag {arg} needs a value. Exiting.")
+                exit(1)
+            jobs = int(args.pop(0))
+        elif arg[0]=='-':
             print(f"Unknown flag {arg}. Exiting.")
             exit(1)
         else:
             filenames.append( arg )
+    if binary and sparse:
+        print("Flags -b and -z can't be used together. Exiting.")
+        exit(1)
+    if reloc and listing:
+        print("Flags -r and -l can't be used together. Exiting.")
+        exit(1)
+
+    todo = [ (filename,binary,symmap,reloc,sparse,listing) for filename in filenames ]
+    if jobs > 1 and len(todo) > 1:
+        with multiprocessing.Pool( jobs ) as pool:
+            results = pool.imap( assemble_file, todo )
+            failed = report( results )
+    else:
+        failed = report( map( assemble_file, todo ) )
+    return( 1 if failed else 0 )
 
-    for filename in filenames:
-        if filename[-2:] != ".s":
-            print(f"Skipping strange looking filename '{filename}'.")
+# Print each file's messages in order. Returns the number that failed.
+def report( results ):
+    failed = 0
+    for ok, messages in results:
+        print(messages,end="")
+        if not ok:
+            failed += 1
+    return failed
+
+# Assemble one file and write its outputs. Returns (success,messages).
+# May execute in a worker process, so messages are collected rather
+# than printed.
+def assemble_file( job ):
+    filename, binary, symmap, reloc, sparse, listing = job
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        ok = _assemble_file( filename, binary, symmap, reloc, sparse, listing )
+    return (ok,messages.getvalue())
+
+def _assemble_file( filename, binary, symmap, reloc, sparse, listing ):
+    if filename[-2:] != ".s":
+        print(f"Skipping strange looking filename '{filename}'.")
+        return False
+    try:
+        with open(filename,"r") as infile:
+            inlines = infile.readlines()
+        if reloc:
+            asm = assemble( filename, inlines )
+            if asm == None:
+                return False
+            obj = make_object( filename, asm )
+            if obj == None:
+                return False
+            write_object( filename[0:-2]+".rel", obj )
         else:
-            objname = filename[0:-2]+".o"
-            with open(filename,"r") as infile:
-                inlines = infile.readlines()
-                outvals = do_assembly( filename, inlines )
-                if outvals != None:
-                    with open(objname,"w") as outfile:
-                        for outval in outvals:
-                            outfile.write(f"{outval:04x}\n")
-    return( 0 )
-
-
-# Remove leading and trailing whitespace, comments, and reduce
-# all inline whitespace to a single space
-def strip_completely( line ):
-    line2 = line.strip().split('#')[0]
-    res = ""
-    was_ws = False
-    for c in line2:
-        if c.isspace():
-            if was_ws:
-                continue
+            asm = assemble( filename, inlines )
+            if asm == None:
+                return False
+            symbols = {}
+            segments = link_segments( filename, asm, symbols )
+            if segments == None:
+                return False
+            if symmap:
+                write_symbols( filename[0:-2]+".sym", symbols )
+            if listing:
+                write_listing( filename[0:-2]+".lst", filename, inlines, asm )
+            if sparse:
+                write_sparse( filename[0:-2]+".o", segments )
             else:
-                res += " "
-                was_ws = True
-        else:
-            res += c
-            was_ws = False
-    return res
+                write_image( filename[0:-2]+(".bin" if binary else ".o"), dense_image(segments), binary )
+    except OSError as e:
+        print(f"{e}. Skipping output for '{filename}'.")
+        return False
+    return True
+
+# An image as the bytes of its file: hex words, one per line, or raw
+# little-endian words.
+def image_bytes( outvals, binary ):
+    if binary:
+        words = array('H',outvals)
+        if sys.byteorder == "big":
+            words.byteswap()
+        return words.tobytes()
+    return "".join( [ f"{outval:04x}\n" for outval in outvals ] ).encode()
+
+def write_image( objname, outvals, binary ):
+    with open(objname,"wb") as outfile:
+        outfile.write( image_bytes(outvals,binary) )
+
+# A sparse image as the bytes of its file: for each (base,words)
+# segment, an "@address" line and then its words in hex.
+def sparse_bytes( segments ):
+    return "".join( [ f"@{base:04x}\n"+"".join( [ f"{w:04x}\n" for w in words ] ) for base, words in segments ] ).encode()
+
+def write_sparse( objname, segments ):
+    with open(objname,"wb") as outfile:
+        outfile.write( sparse_bytes(segments) )
+
+# The listing of an assembly that has been through link_segments(), as
+# the bytes of its file. inlines are the source lines it came from.
+def listing_bytes( filename, inlines, asm ):
+    segments = asm["segments"]
+    bases = [ segment["origin"] or 0 for segment in segments ]
+    labels_at = {}
+    for name, place in asm["labels"].items():
+        labels_at.setdefault( place, [] ).append( name )
+    out = []
+    for seg in sorted( range(0,len(segments)), key=lambda i:bases[i] ):
+        base = bases[seg]
+        words = segments[seg]["words"]
+        lines = segments[seg]["lines"]
+        last = None
+        for offset in range(0,len(words)+1):
+            for name in sorted( labels_at.get( (seg,offset), [] ) ):
+                out.append( f"{base+offset:04x}        {name}:" )
+            if offset == len(words):
+                break
+            lineno = lines[offset]
+            src = inlines[lineno-1].strip() if lineno != last else ""
+            out.append( f"{base+offset:04x}  {words[offset]:04x}  {filename}:{lineno:<6} {src}".rstrip() )
+            last = lineno
+    return "".join( [ line+"\n" for line in out ] ).encode()
+
+def write_listing( lstname, filename, inlines, asm ):
+    with open(lstname,"wb") as outfile:
+        outfile.write( listing_bytes(filename,inlines,asm) )
+
+def symbols_bytes( symbols ):
+    return "".join( [ f"{addr:04x} {name}\n" for name, addr in sorted( symbols.items(), key=lambda s:(s[1],s[0]) ) ] ).encode()
+
+def write_symbols( symname, symbols ):
+    with open(symname,"wb") as outfile:
+        outfile.write( symbols_bytes(symbols) )
+
+
+# A source line: a label, or a mnemonic (with any .condition) or
+# directive and its arguments, either way with an optional comment.
+_line_re = re.compile( r"\s*(?:(?P<label>[^\s#:]+):|(?P<op>[.\w]+)(?:\s+(?P<args>[^#]*?))?)?\s*(?:#.*)?$" )
+_comma_re = re.compile( r"\s*,\s*" )
+
+class AsmError(Exception):
+    pass
 
 
 def get_regnum(rstr):
@@ -61,33 +238,75 @@ def get_regnum(rstr):
     endloc = rstr.index('[') if '[' in rstr else None
     return int(rstr[1:endloc])
 
-def get_subindex(rstr):
+# Plain register names, looked up before falling back to get_regnum().
+_regnums = dict( [ (f"r{n}",n) for n in range(0,16) ] + [ ("ip",15), ("sp",14), ("fl",13), ("ct",12) ] )
+
+def regnum(rstr):
+    n = _regnums.get(rstr)
+    return n if n != None else get_regnum(rstr)
+
+# The value of an operand that has to be known now: a number, or an
+# expression over .equ names already set.
+def get_constant(vstr, equs={}):
+    try:
+        return int(vstr,0)
+    except ValueError:
+        pass
+    try:
+        return evaluate(vstr,equs.get)
+    except Undefined as e:
+        raise AsmError(f"'{e.name}' must be set by .equ before it's used here")
+
+# The value of an operand that can be left to link time, adding a reloc
+# of the given mode if it has to be.
+def get_value(vstr, equs, where, mode, relocs):
+    try:
+        return int(vstr,0)
+    except ValueError:
+        pass
+    if vstr.isidentifier():     # Most often just a label.
+        val = equs.get(vstr)
+        if val == None:
+            relocs.append((where,mode,vstr))
+            return 0
+        return val
+    try:
+        return evaluate(vstr,equs.get)
+    except Undefined:
+        relocs.append((where,mode,canonical(vstr)))
+        return 0
+
+def get_subindex(rstr, equs={}):
     if '[' in rstr:
-        return int(rstr[rstr.index('[')+1:-1])
+        return get_constant(rstr[rstr.index('[')+1:-1],equs)
     return 0
 
-def get_smallvalue(vstr):
-    return int(vstr,0)%0x10
+def get_smallvalue(vstr, equs={}):
+    return get_constant(vstr,equs)%0x10
+
+_reg_re = re.compile( r"(r\d+|ip|fl|sp|ct)(\[|[+-]?$)" )
 
 def get_opmode(rstr):
-    if rstr[0]=='r' or rstr[:2] in ["ip","fl","sp","ct"]:
+    if rstr in _regnums or _reg_re.match(rstr):
         return 0
     else:
         return 1
 
-def get_cond(cstr):
+_cond_letters = {
+    "a": (0,False),
+    "A": (0,True),
+    "e": (1,False),
+    "E": (1,True),
+    "g": (2,False),
+    "G": (2,True),
+}
+
+def _parse_cond(cstr):
     seen_pos = False
     seen_neg = False
     f = 0
     for c in cstr:
-        i = {
-            "a": (0,False),
-            "A": (0,True),
-            "e": (1,False),
-            "E": (1,True),
-            "g": (2,False),
-            "G": (2,True),
-        }.get(c,None)
+        i = _cond_letters.get(c,None)
         if i:
             if i[1]:
                 seen_neg = True
@@ -104,6 +323,20 @@ def get_cond(cstr):
         f |= 8
     return f
 
+# Condition codes seen so far.
+_conds = {}
+
+def get_cond(cstr):
+    if cstr not in _conds:
+        _conds[cstr] = _parse_cond(cstr)
+    return _conds[cstr]
+
+def _need_cond(cstr):
+    cc = get_cond(cstr)
+    if not cc:
+        raise AsmError(f"Failed to parse condition code '{cstr}'")
+    return cc
+
 fmt1 = {
     "jp":1,
 }
@@ -123,6 +356,9 @@ fmt2 = {
     "mov":11,
 }
 
+# Mode field for the bitwise ops.
+fmt2_modes = {"and":0,"or":1,"xor":2,"shl":3,"shr":4}
+
 fmt3 = {
     "const": 9,
 }
@@ -139,153 +375,512 @@ fmt5 = {
     "br":2,
 }
 
-def do_assembly( filename, lines ):
-    target_address = 0
+
+# Encoders, one per instruction format. Each is given the mnemonic,
+# condition string, operand strings, position (for relocs), the reloc
+# list and the .equ values, and returns the encoded word, raising
+# AsmError if it can't.
+def _enc_halt( mn, cstr, ops, where, relocs, equs ):
+    return 0
+
+def _enc_fmt1( mn, cstr, ops, where, relocs, equs ):
+    r1 = regnum(ops[0])
+    r2 = regnum(ops[1])
+    return (fmt1[mn]<<12) | (r1<<8) | (r2<<4) | _need_cond(cstr)
+
+def _enc_fmt2( mn, cstr, ops, where, relocs, equs ):
+    a = get_opmode(ops[0])
+    r1 = get_smallvalue(ops[0],equs) if a==1 else regnum(ops[0])
+    r2 = regnum(ops[1])
+    i = 0
+    if mn == "st":
+        i = get_subindex(ops[1],equs)
+    elif mn == "ld":
+        i = get_subindex(ops[0],equs)
+    elif mn in fmt2_modes:
+        i = fmt2_modes[mn]
+    return (fmt2[mn]<<12) | (r1<<8) | (r2<<4) | (a<<3) | (i&7)
+
+def _enc_fmt3( mn, cstr, ops, where, relocs, equs ):
+    r = regnum(ops[1])
+    cshift = 0
+    if ops[0][0:3]=="hi(":
+        opstr = ops[0][3:-1]
+        cshift = 8
+    elif ops[0][0:3]=="lo(":
+        opstr = ops[0][3:-1]
+    else:
+        opstr = ops[0]
+    c = ( get_value(opstr,equs,where,"highbyte" if cshift==8 else "lowbyte",relocs)>>cshift ) % 256
+    return (fmt3[mn]<<12) | (r<<8) | c
+
+def _enc_fmt4( mn, cstr, ops, where, relocs, equs ):
+    if mn == "call":
+        c = regnum(ops[0])<<4
+    elif mn == "nop":
+        c = 0
+    else:
+        c = get_constant(ops[0],equs)&255
+    return (fmt4[mn]<<8) | c
+
+def _enc_fmt5( mn, cstr, ops, where, relocs, equs ):
+    nrelocs = len(relocs)
+    c = get_value(ops[0],equs,where,"addrdelta",relocs)
+    if len(relocs) == nrelocs and (c>127 or c<-128):
+        raise AsmError(f"Branch out of range. {c}")
+    return (fmt5[mn]<<12) | ((c&255)<<4) | _need_cond(cstr)
+
+_encoders = { "halt": _enc_halt }
+_encoders.update( [ (mn,_enc_fmt1) for mn in fmt1 ] )
+_encoders.update( [ (mn,_enc_fmt2) for mn in fmt2 ] )
+_encoders.update( [ (mn,_enc_fmt3) for mn in fmt3 ] )
+_encoders.update( [ (mn,_enc_fmt4) for mn in fmt4 ] )
+_encoders.update( [ (mn,_enc_fmt5) for mn in fmt5 ] )
+
+
+# Macro expansions nested deeper than this are taken to be runaway.
+_MAX_MACRO_DEPTH = 64
+
+_macro_arg_re = re.compile( r"\\(\w+|@)" )
+_macro_name_re = re.compile( r"[A-Za-z_]\w*$" )
+
+# A macro, parsed from its definition. Each line of the body is split
+# into text and the parameters to put between it, so using the macro is
+# just joins. Expansions are kept, unless the body uses \@.
+class _Macro():
+    def __init__(self, name, params, body):
+        self.name = name
+        self.params = params
+        self.unique = False
+        self.lines = []
+        for line in body:
+            parts = _macro_arg_re.split( line )
+            for n in range(1,len(parts),2):
+                if parts[n] == "@":
+                    parts[n] = None
+                    self.unique = True
+                elif parts[n] in params:
+                    parts[n] = params.index(parts[n])
+                else:
+                    raise AsmError(f"Macro '{name}' has no parameter '{parts[n]}'")
+            self.lines.append( parts )
+        self.expansions = {}
+
+    def expand( self, args, count ):
+        if len(args) != len(self.params):
+            raise AsmError(f"Macro '{self.name}' takes {len(self.params)} arguments, not {len(args)}")
+        key = tuple(args)
+        res = self.expansions.get(key)
+        if res == None:
+            res = []
+            for parts in self.lines:
+                line = parts[0]
+                for n in range(1,len(parts),2):
+                    line += ( str(count) if parts[n] == None else args[parts[n]] )+parts[n+1]
+                res.append( line )
+            if not self.unique:
+                self.expansions[key] = res
+        return res
+
+# Lines to assemble, as (line number,text), with macro expansions pushed
+# in ahead of the rest as they come up.
+class _Source():
+    def __init__(self, lines):
+        self.stack = [ enumerate(lines,1) ]
+
+    def push( self, lineno, lines ):
+        if len(self.stack) > _MAX_MACRO_DEPTH:
+            raise AsmError("Macros nested too deeply")
+        self.stack.append( iter( [ (lineno,line) for line in lines ] ) )
+
+    def __iter__( self ):
+        stack = self.stack
+        while stack != []:
+            top = stack[-1]
+            for item in top:
+                yield item
+                if stack[-1] is not top:
+                    break
+            else:
+                stack.pop()
+
+
+# Assemble lines, leaving relocs unapplied. Output is a list of segments,
+# each a dict of "origin", "words" and "lines" (the source line number
+# of each word, from 1): the first (origin None) holds
+# anything before the first .org, and each .org starts another. Places
+# in the output are given as (segment,offset). Returns a dict of the
+# segments ("segments"), labels ("labels", name -> place), relocs
+# ("relocs", as (place,mode,label)), labels named by .global
+# ("globals") and the register for relax() to use ("scratch", or None),
+# or None on failure.
+def assemble( filename, lines ):
+    segments = [ { "origin": None, "words": [], "lines": [] } ]
+    seg = 0
+    outvals = segments[0]["words"]
+    outlines = segments[0]["lines"]
     labels = {}
     relocs = []
-    outvals = []
-    for rawline in lines:
-        line = strip_completely(rawline)
-        if line=="":
+    globals_ = set()
+    scratch = 0
+    equs = {}               # .equ names with known values.
+    equ_exprs = {}          # Those that depend on labels, as expressions.
+    macros = {}
+    expansions = 0
+    source = _Source( lines )
+    source_lines = iter( source )
+    line_match = _line_re.match
+    comma_split = _comma_re.split
+    encoders = _encoders
+    # Instruction lines already seen that needed no reloc, with their
+    # encodings. Generated code repeats the same lines a great deal.
+    known = {}
+    for lineno, rawline in source_lines:
+        val = known.get(rawline)
+        if val != None:
+            outvals.append(val)
+            outlines.append(lineno)
             continue
-        if line[0]=='.':          # Directive
-            parts = line.split(" ")
-            if parts[0] == ".word":
-                val = 0
-                try:
-                    val = int(parts[1],0) % 65536
-                except:
-                    relocs.append((target_address,"word",parts[1]))
+        m = line_match(rawline)
+        if m == None:
+            print(f"Unable to parse '{rawline.strip()}'. Skipping output for '{filename}'.")
+            return None
+        label, op, args = m.group("label","op","args")
+        try:
+            if op == None:
+                if label != None:
+                    if label in equs or label in equ_exprs:
+                        raise AsmError(f"'{label}' is already set by .equ")
+                    labels[label] = (seg,len(outvals))
+            elif op[0]=='.':        # Directive
+                parts = args.split() if args else []
+                if op == ".word":
+                    outvals.append(get_value(args,equs,(seg,len(outvals)),"word",relocs) % 65536)
+                    outlines.append(lineno)
+                elif op == ".global":
+                    globals_.update( [ name for name in re.split(r"[,\s]+",args or "") if name != "" ] )
+                elif op == ".scratch":
+                    scratch = None if parts[0] == "none" else regnum(parts[0])
+                elif op == ".equ":
+                    name, _, expr = args.partition(",")
+                    name = name.strip()
+                    if not _macro_name_re.match(name):
+                        raise AsmError(f"Bad .equ name '{name}'")
+                    if name in equs or name in equ_exprs or name in labels:
+                        raise AsmError(f"'{name}' is already defined")
+                    try:
+                        equs[name] = evaluate(expr.strip(),equs.get)
+                    except Undefined:
+                        equ_exprs[name] = canonical(expr.strip())
+                elif op == ".macro":
+                    name, _, params = args.partition(" ") if args else ("","","")
+                    params = [ param for param in comma_split(params.strip()) if param != "" ]
+                    if not _macro_name_re.match(name) or name in encoders:
+                        raise AsmError(f"Bad macro name '{name}'")
+                    body = []
+                    for bodyno, bodyline in source_lines:
+                        bm = line_match(bodyline)
+                        bop = bm.group("op") if bm != None else None
+                        if bop == ".endm":
+                            break
+                        elif bop == ".macro":
+                            raise AsmError(f"Macro '{name}' defined inside another")
+                        body.append( bodyline.rstrip("\n") )
+                    else:
+                        raise AsmError(f"Macro '{name}' has no .endm")
+                    macros[name] = _Macro( name, params, body )
+                elif op == ".org":
+                    segments.append( { "origin": int(parts[0],0) % 65536, "words": [], "lines": [] } )
+                    seg = len(segments)-1
+                    outvals = segments[seg]["words"]
+                    outlines = segments[seg]["lines"]
+                else:
+                    raise AsmError(f"Unknown directive '{op}'")
+            else:                   # An instruction
+                mn, _, cstr = op.partition(".")
+                encoder = encoders.get(mn)
+                ops = comma_split(args) if args else []
+                if encoder == None:
+                    macro = macros.get(op)
+                    if macro == None:
+                        raise AsmError(f"Unknown opcode '{mn}'")
+                    expansions += 1
+                    source.push( lineno, macro.expand( ops, expansions ) )
+                    continue
+                nrelocs = len(relocs)
+                val = encoder( mn, cstr or "a", ops, (seg,len(outvals)), relocs, equs )
+                if len(relocs) == nrelocs:
+                    known[rawline] = val
                 outvals.append(val)
-                target_address += 1
-            elif parts[0] == ".org":
-                new_address = int(parts[1],0) % 65536
-                if new_address < target_address:
-                    print(f"Unable to process OoO orgs. Skipping output for '{filename}'.")
+                outlines.append(lineno)
+        except AsmError as e:
+            print(f"{e}. Skipping output for '{filename}'.")
+            return None
+        except ExprError as e:
+            print(f"{e} in '{rawline.strip()}'. Skipping output for '{filename}'.")
+            return None
+        except (IndexError,ValueError):
+            print(f"Bad operands in '{rawline.strip()}'. Skipping output for '{filename}'.")
+            return None
+
+    # Relocs can use .equ names set later on or set from labels. Put in
+    # their values, leaving just labels, and apply any that then need
+    # none (bar branches, which depend on where they are).
+    if equs or equ_exprs:
+        values = dict( [ (name,str(val)) for name, val in equs.items() ] )
+        values.update( equ_exprs )
+        left = []
+        for (where,mode,valt) in relocs:
+            rounds = 0
+            while names(valt) & values.keys():
+                rounds += 1
+                if rounds > len(values):
+                    print(f"The .equ for '{valt}' refers to itself. Skipping output for '{filename}'.")
                     return None
-                while target_address < new_address:
-                    outvals.append(0)
-                    target_address+=1
-            else:
-                print(f"Unknown directive '{parts[0]}'. Skipping output for '{filename}'.")
-                return None
-        elif line[-1] == ':':    # Label
-            labels[line[0:-1]] = target_address
-        else:                   # An instruction
-            splpos = line.find(" ")
-            if splpos == -1:
-                parts = [line]
-            else:
-                parts = [line[0:splpos],line[splpos+1:]]
-            instr = parts[0].split(".")
-            if len(parts) > 1:
-                ops = [x.strip() for x in parts[1].split(",")]
+                valt = canonical( valt, values )
+            if mode != "addrdelta" and names(valt) == set():
+                words = segments[where[0]]["words"]
+                words[where[1]] = apply_reloc( words[where[1]], mode, evaluate(valt,equs.get), 0 )
             else:
-                ops = []
-            if len(instr) == 1:
-                instr.append("a")
-            val = 0
-            if instr[0] == "halt":
-                val = 0
-            elif instr[0] in fmt1:
-                r1 = get_regnum(ops[0])
-                r2 = get_regnum(ops[1])
-                cc = get_cond(instr[1])
-                if not cc:
-                    print(f"Failed to parse condition code '{instr[1]}'. Skipping output for '{filename}'")
-                    return None
-                oc = fmt1[instr[0]]
-                val = (oc<<12) | (r1<<8) | (r2<<4) | cc
-            elif instr[0] in fmt2:
-                i=0
-                a = get_opmode(ops[0])
-                if a==1:
-                    r1 = get_smallvalue(ops[0])
-                else:
-                    r1 = get_regnum(ops[0])
-                r2 = get_regnum(ops[1])
-                if instr[0] == "st":
-                    i = get_subindex(ops[1])
-                elif instr[0] == "ld":
-                    i = get_subindex(ops[0])
-                elif instr[0] in ["and","or","xor","shl","shr"]:
-                    i = {"and":0,"or":1,"xor":2,"shl":3,"shr":4}[instr[0]]
-                oc = fmt2[instr[0]]
-                val = (oc<<12) | (r1<<8) | (r2<<4) | (a<<3) | (i&7)
-            elif instr[0] in fmt3:
-                r = get_regnum(ops[1])
-                c = 0
-                cshift = 0
-                if ops[0][0:3]=="hi(":
-                    opstr = ops[0][3:-1]
-                    cshift = 8
-                elif ops[0][0:3]=="lo(":
-                    opstr = ops[0][3:-1]
-                else:
-                    opstr = ops[0]
+                left.append( (where,mode,valt) )
+        relocs = left
+
+    return { "segments": segments, "labels": labels, "relocs": relocs, "globals": globals_, "scratch": scratch }
+
+
+# Long forms of a br, given its condition and the scratch register: the
+# words, with the offsets of the const hi and const lo within them.
+# Unconditionally it's just a jp. A condition on one flag is inverted to
+# branch round the jp; any other needs a branch to the jp and another
+# round it.
+def _long_branch( cond, scratch ):
+    const = (fmt3["const"]<<12) | (scratch<<8)
+    jp = (fmt1["jp"]<<12) | (scratch<<8) | (scratch<<4) | get_cond("a")
+    if cond == get_cond("a"):
+        return ([const,const,jp],0)
+    elif (cond&7) in [1,2,4]:
+        return ([(fmt5["br"]<<12) | (4<<4) | (cond^8),const,const,jp],1)
+    return ([(fmt5["br"]<<12) | (2<<4) | cond,(fmt5["br"]<<12) | (4<<4) | get_cond("a"),const,const,jp],2)
+
+# Lengthen the branches of an assembly that can't reach their labels,
+# working on it in place. bases gives the address of each segment, or
+# None where that isn't known yet, in which case branches out of the
+# segment are lengthened. Branches to labels not defined here are left
+# alone if final, otherwise lengthened. Lengthening a branch can only
+# push others out of range, not in, so this is repeated until nothing
+# changes.
+def relax( asm, bases, final ):
+    scratch = asm["scratch"]
+    relocs = asm["relocs"]
+    labels = asm["labels"]
+    branches = [ i for i, (place,mode,valt) in enumerate(relocs) if mode=="addrdelta" ]
+    if scratch == None or branches == []:
+        return
+    segments = asm["segments"]
+
+    # Per segment, the offsets of the long branches and the words added
+    # by them and those before.
+    grown = [ ([],[]) for segment in segments ]
+    def moved( seg, offset ):
+        offsets, added = grown[seg]
+        n = bisect.bisect_left( offsets, offset )
+        return offset+(added[n-1] if n else 0)
+
+    long_ = set()
+    changed = True
+    while changed:
+        changed = False
+        for i in branches:
+            if i in long_:
+                continue
+            (seg,offset),mode,valt = relocs[i]
+            if valt not in labels:
+                # An expression: worked out from where labels will be,
+                # if that's known yet.
+                def address( name ):
+                    place = labels.get(name)
+                    if place == None or bases[place[0]] == None:
+                        return None
+                    return bases[place[0]]+moved(*place)
                 try:
-                    c = ( int(opstr,0)>>cshift ) % 256
-                except:
-                    if cshift==8:
-                        relocs.append((target_address,"highbyte",ops[0]))
-                    else:
-                        relocs.append((target_address,"lowbyte",ops[0]))
-                oc = fmt3[instr[0]]
-                val = (oc<<12) | (r<<8) | c
-            elif instr[0] in fmt4:
-                opcode = 0
-                subcode = fmt4[instr[0]]
-                if instr[0] == "call":
-                    c = get_regnum(ops[0])<<4
-                elif instr[0] == "nop":
-                    c=0
+                    if bases[seg] == None:
+                        raise Undefined(valt)
+                    far = not in_branch_range( branch_delta( evaluate(valt,address), bases[seg]+moved(seg,offset) ) )
+                except Undefined:
+                    far = not final
+            else:
+                vseg, voffset = labels[valt]
+                if vseg == seg:
+                    far = not in_branch_range( moved(vseg,voffset)-moved(seg,offset) )
+                elif bases[seg] == None or bases[vseg] == None:
+                    far = True
                 else:
-                    c = int(ops[0],0)&255
-                val = (opcode<<12) | (subcode<<8) | c
-            elif instr[0] in fmt5:
-                opstr = ops[0]
-                try:
-                    c = int(opstr,0)
-                    if c>127 or c<-128:
-                        print(f"Branch out of range. {c}")
-                        return None
-                except:
-                    relocs.append((target_address,"addrdelta",ops[0]))
-                cc = get_cond(instr[1])
-                if not cc:
-                    print(f"Failed to parse condition code '{instr[1]}'. Skipping output for '{filename}'")
-                    return None
-                oc = fmt5[instr[0]]
-                val = (oc<<12) | (c<<4) | cc
+                    far = not in_branch_range( branch_delta( bases[vseg]+moved(vseg,voffset), bases[seg]+moved(seg,offset) ) )
+            if far:
+                long_.add( i )
+                changed = True
+        if changed:
+            for seg, segment in enumerate(segments):
+                sites = sorted( [ relocs[i][0][1] for i in long_ if relocs[i][0][0] == seg ] )
+                added = []
+                total = 0
+                for offset in sites:
+                    total += len( _long_branch( segment["words"][offset]&15, scratch )[0] )-1
+                    added.append( total )
+                grown[seg] = (sites,added)
+
+    if long_ == set():
+        return
+    longs = {}
+    for i in long_:
+        longs[relocs[i][0]] = relocs[i][2]
+    newrelocs = []
+    for i, ((seg,offset),mode,valt) in enumerate(relocs):
+        if i not in long_:
+            newrelocs.append( ((seg,moved(seg,offset)),mode,valt) )
+    for seg, segment in enumerate(segments):
+        words = []
+        lines = []
+        for offset, word in enumerate(segment["words"]):
+            valt = longs.get( (seg,offset) )
+            if valt == None:
+                words.append( word )
+                lines.append( segment["lines"][offset] )
             else:
-                print(f"Unknown opcode '{instr[0]}'. Skipping output for '{filename}'.")
-                return None
-            if val != None:
-                outvals.append(val)
-                target_address += 1
+                seq, hi = _long_branch( word&15, scratch )
+                newrelocs.append( ((seg,len(words)+hi),"highbyte",valt) )
+                newrelocs.append( ((seg,len(words)+hi+1),"lowbyte",valt) )
+                words += seq
+                lines += [ segment["lines"][offset] ]*len(seq)
+        segment["words"][:] = words
+        segment["lines"][:] = lines
+    for name, (seg,offset) in labels.items():
+        labels[name] = (seg,moved(seg,offset))
+    relocs[:] = newrelocs
+
+
+
+# Link an assembly where it stands, the first segment going at 0. Returns
+# a list of (base,words) for the segments with anything in them, in
+# address order, or None on failure. If symbols is given, the labels
+# found are added to it (name -> address).
+def link_segments( filename, asm, symbols=None ):
+    segments = asm["segments"]
+    bases = [ segment["origin"] or 0 for segment in segments ]
+    relax( asm, bases, True )
+    labels = dict( [ (name,bases[seg]+offset) for name, (seg,offset) in asm["labels"].items() ] )
 
     # Apply local relocations.
-    for (tgt,mode,full_valt) in relocs:
-        if full_valt[0:3]=="hi(" or full_valt[0:3]=="lo(":
-            valt = full_valt[3:-1]
-        else:
-            valt = full_valt
-        if valt not in labels:
-            print(f"Attempt to use label '{valt}' not resolved. Skipping output for '{filename}'")
+    for ((seg,offset),mode,valt) in asm["relocs"]:
+        val = labels.get(valt)
+        if val == None:
+            try:
+                val = evaluate(valt,labels.get)
+            except Undefined as e:
+                print(f"Attempt to use label '{e.name}' not resolved. Skipping output for '{filename}'")
+                return None
+        words = segments[seg]["words"]
+        try:
+            words[offset] = apply_reloc( words[offset], mode, val, bases[seg]+offset )
+        except ValueError as e:
+            print(f"{e} ('{valt}'). Skipping output for '{filename}'")
             return None
-        val = labels[valt]
-        if mode=="word":
-            outvals[tgt] = val
-        elif mode=="lowbyte":
-            outvals[tgt] = (outvals[tgt]&0xff00)|(val&0xff)
-        elif mode=="highbyte":
-            outvals[tgt] = (outvals[tgt]&0xff00)|((val>>8)&0xff)
-        elif mode=="addrdelta":
-            outvals[tgt] = (outvals[tgt]&0xf00f)|(((val-tgt)&0xff)<<4)
-        else:
-            print(f"Failed to apply reloc '{mode}' using '{valt}'. Skipping output for '{filename}'")
+
+    res = sorted( [ (bases[i],segment["words"]) for i, segment in enumerate(segments) if segment["words"] ], key=lambda r:r[0] )
+    for (base1,words1), (base2,words2) in zip(res,res[1:]):
+        if base2 < base1+len(words1):
+            print(f"Segments at {base1:04x} and {base2:04x} overlap. Skipping output for '{filename}'")
             return None
+    if res != [] and res[-1][0]+len(res[-1][1]) > 65536:
+        print(f"Segment at {res[-1][0]:04x} runs off the end of memory. Skipping output for '{filename}'")
+        return None
+    if symbols != None:
+        symbols.update(labels)
+    return res
+
+# Fill in the gaps between segments to make a single image from 0.
+def dense_image( segments ):
+    if segments == []:
+        return []
+    outvals = [ 0 for i in range(0,segments[-1][0]+len(segments[-1][1])) ]
+    for base, words in segments:
+        outvals[base:base+len(words)] = words
     return outvals
 
-work()
+# Assemble lines into a list of words, fully linked. If symbols is given,
+# the labels found are added to it (name -> address).
+def do_assembly( filename, lines, symbols=None ):
+    asm = assemble( filename, lines )
+    if asm == None:
+        return None
+    segments = link_segments( filename, asm, symbols )
+    if segments == None:
+        return None
+    return dense_image( segments )
+
+
+# Turn an assembly into a relocatable object. Each segment becomes a
+# section, the first (if it's used) placeable anywhere, those from .orgs
+# fixed where they say. Relocs that don't depend on where things end up
+# (between fixed sections, or branches within a section) are applied
+# here; the rest are left in the object.
+def make_object( filename, asm ):
+    segments = asm["segments"]
+    labels = asm["labels"]
+    relax( asm, [ segment["origin"] for segment in segments ], False )
+
+    # The first segment is dropped if nothing is in or refers to it.
+    first_used = segments[0]["words"] != [] or any( [ seg == 0 for (seg,offset) in labels.values() ] )
+    renumber = 0 if first_used else 1
+    if not first_used:
+        segments = segments[1:]
+
+    exported = asm["globals"] if asm["globals"] else set(labels)
+    for name in exported:
+        if name not in labels:
+            print(f"Global '{name}' is never defined. Skipping output for '{filename}'")
+            return None
+    symbols = [ (name,seg-renumber,offset,name in exported) for name, (seg,offset) in sorted( labels.items(), key=lambda l:(l[1],l[0]) ) ]
+
+    # Where labels in fixed sections are.
+    def fixed_address( name ):
+        place = labels.get(name)
+        if place == None or segments[place[0]-renumber]["origin"] == None:
+            return None
+        return segments[place[0]-renumber]["origin"]+place[1]
+
+    relocs = []
+    for ((seg,offset),mode,valt) in asm["relocs"]:
+        seg -= renumber
+        words = segments[seg]["words"]
+        if valt not in labels and segments[seg]["origin"] != None:
+            try:
+                words[offset] = apply_reloc( words[offset], mode, evaluate(valt,fixed_address), segments[seg]["origin"]+offset )
+                continue
+            except Undefined:
+                pass
+            except ValueError as e:
+                print(f"{e} ('{valt}'). Skipping output for '{filename}'")
+                return None
+        elif valt in labels:
+            vseg, voffset = labels[valt]
+            vseg -= renumber
+            origin = segments[seg]["origin"]
+            vorigin = segments[vseg]["origin"]
+            try:
+                if origin != None and vorigin != None:
+                    words[offset] = apply_reloc( words[offset], mode, vorigin+voffset, origin+offset )
+                    continue
+                elif mode=="addrdelta" and seg==vseg:
+                    words[offset] = apply_reloc( words[offset], mode, voffset, offset )
+                    continue
+            except ValueError as e:
+                print(f"{e} ('{valt}'). Skipping output for '{filename}'")
+                return None
+        relocs.append( (seg,offset,mode,valt) )
+
+    sections = [ { "origin": segment["origin"], "words": segment["words"] } for segment in segments ]
+    return { "sections": sections, "symbols": symbols, "relocs": relocs }
 
+if __name__ == '__main__':
+    exit( work() )
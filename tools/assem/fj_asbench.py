@@ -0,0 +1,345 @@
+#
+# This file is part of the Flapjack assembler
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Assembler benchmark. Assembles a synthetic source file with the
+# current assembler and with the original line-at-a-time one, checks
+# they agree and reports lines per second for each.
+#
+# Usage: fj_asbench.py [lines]
+#
+# lines defaults to 60000, which is around 52K words: the program has to
+# fit in the 64K word address space.
+#
+
+import sys
+import time
+import random
+
+from fj_as import do_assembly
+
+
+# The original assembler, kept verbatim (bar names) as the baseline.
+# Remove leading and trailing whitespace, comments, and reduce
+# all inline whitespace to a single space
+def _baseline_strip_completely( line ):
+    line2 = line.strip().split('#')[0]
+    res = ""
+    was_ws = False
+    for c in line2:
+        if c.isspace():
+            if was_ws:
+                continue
+            else:
+                res += " "
+                was_ws = True
+        else:
+            res += c
+            was_ws = False
+    return res
+
+
+def _baseline_get_regnum(rstr):
+    rstr = rstr[:-1] if rstr[-1] in ["+","-"] else rstr
+    if rstr[:2]=="ip":
+        return 15
+    elif rstr[:2]=="sp":
+        return 14
+    elif rstr[:2]=="fl":
+        return 13
+    elif rstr[:2]=="ct":
+        return 12
+    endloc = rstr.index('[') if '[' in rstr else None
+    return int(rstr[1:endloc])
+
+def _baseline_get_subindex(rstr):
+    if '[' in rstr:
+        return int(rstr[rstr.index('[')+1:-1])
+    return 0
+
+def _baseline_get_smallvalue(vstr):
+    return int(vstr,0)%0x10
+
+def _baseline_get_opmode(rstr):
+    if rstr[0]=='r' or rstr[:2] in ["ip","fl","sp","ct"]:
+        return 0
+    else:
+        return 1
+
+def _baseline_get_cond(cstr):
+    seen_pos = False
+    seen_neg = False
+    f = 0
+    for c in cstr:
+        i = {
+            "a": (0,False),
+            "A": (0,True),
+            "e": (1,False),
+            "E": (1,True),
+            "g": (2,False),
+            "G": (2,True),
+        }.get(c,None)
+        if i:
+            if i[1]:
+                seen_neg = True
+            else:
+                seen_pos = True
+            f |= 1<<i[0]
+        else:
+            return None
+    if seen_pos and seen_neg:
+        return None
+    if not ( seen_pos or seen_neg ):
+        return None
+    if seen_pos:
+        f |= 8
+    return f
+
+_baseline_fmt1 = {
+    "jp":1,
+}
+
+_baseline_fmt2 = {
+    "ld":3,
+    "st":4,
+    "add":5,
+    "sub":6,
+    "cmp":7,
+    "out":8,
+    "and":10,
+    "or":10,
+    "xor":10,
+    "shr":10,
+    "shl":10,
+    "mov":11,
+}
+
+_baseline_fmt3 = {
+    "const": 9,
+}
+
+# All the main opcodes are zero. Subcode are given here.
+_baseline_fmt4 = {
+    "nop": 0,
+    "call": 1,
+    "saveh": 2,
+    "ret": 3
+}
+
+_baseline_fmt5 = {
+    "br":2,
+}
+
+def _baseline_do_assembly( filename, lines ):
+    target_address = 0
+    labels = {}
+    relocs = []
+    outvals = []
+    for rawline in lines:
+        line = _baseline_strip_completely(rawline)
+        if line=="":
+            continue
+        if line[0]=='.':          # Directive
+            parts = line.split(" ")
+            if parts[0] == ".word":
+                val = 0
+                try:
+                    val = int(parts[1],0) % 65536
+                except:
+                    relocs.append((target_address,"word",parts[1]))
+                outvals.append(val)
+                target_address += 1
+            elif parts[0] == ".org":
+                new_address = int(parts[1],0) % 65536
+                if new_address < target_address:
+                    print(f"Unable to process OoO orgs. Skipping output for '{filename}'.")
+                    return None
+                while target_address < new_address:
+                    outvals.append(0)
+                    target_address+=1
+            else:
+                print(f"Unknown directive '{parts[0]}'. Skipping output for '{filename}'.")
+                return None
+        elif line[-1] == ':':    # Label
+            labels[line[0:-1]] = target_address
+        else:                   # An instruction
+            splpos = line.find(" ")
+            if splpos == -1:
+                parts = [line]
+            else:
+                parts = [line[0:splpos],line[splpos+1:]]
+            instr = parts[0].split(".")
+            if len(parts) > 1:
+                ops = [x.strip() for x in parts[1].split(",")]
+            else:
+                ops = []
+            if len(instr) == 1:
+                instr.append("a")
+            val = 0
+            if instr[0] == "halt":
+                val = 0
+            elif instr[0] in _baseline_fmt1:
+                r1 = _baseline_get_regnum(ops[0])
+                r2 = _baseline_get_regnum(ops[1])
+                cc = _baseline_get_cond(instr[1])
+                if not cc:
+                    print(f"Failed to parse condition code '{instr[1]}'. Skipping output for '{filename}'")
+                    return None
+                oc = _baseline_fmt1[instr[0]]
+                val = (oc<<12) | (r1<<8) | (r2<<4) | cc
+            elif instr[0] in _baseline_fmt2:
+                i=0
+                a = _baseline_get_opmode(ops[0])
+                if a==1:
+                    r1 = _baseline_get_smallvalue(ops[0])
+                else:
+                    r1 = _baseline_get_regnum(ops[0])
+                r2 = _baseline_get_regnum(ops[1])
+                if instr[0] == "st":
+                    i = _baseline_get_subindex(ops[1])
+                elif instr[0] == "ld":
+                    i = _baseline_get_subindex(ops[0])
+                elif instr[0] in ["and","or","xor","shl","shr"]:
+                    i = {"and":0,"or":1,"xor":2,"shl":3,"shr":4}[instr[0]]
+                oc = _baseline_fmt2[instr[0]]
+                val = (oc<<12) | (r1<<8) | (r2<<4) | (a<<3) | (i&7)
+            elif instr[0] in _baseline_fmt3:
+                r = _baseline_get_regnum(ops[1])
+                c = 0
+                cshift = 0
+                if ops[0][0:3]=="hi(":
+                    opstr = ops[0][3:-1]
+                    cshift = 8
+                elif ops[0][0:3]=="lo(":
+                    opstr = ops[0][3:-1]
+                else:
+                    opstr = ops[0]
+                try:
+                    c = ( int(opstr,0)>>cshift ) % 256
+                except:
+                    if cshift==8:
+                        relocs.append((target_address,"highbyte",ops[0]))
+                    else:
+                        relocs.append((target_address,"lowbyte",ops[0]))
+                oc = _baseline_fmt3[instr[0]]
+                val = (oc<<12) | (r<<8) | c
+            elif instr[0] in _baseline_fmt4:
+                opcode = 0
+                subcode = _baseline_fmt4[instr[0]]
+                if instr[0] == "call":
+                    c = _baseline_get_regnum(ops[0])<<4
+                elif instr[0] == "nop":
+                    c=0
+                else:
+                    c = int(ops[0],0)&255
+                val = (opcode<<12) | (subcode<<8) | c
+            elif instr[0] in _baseline_fmt5:
+                opstr = ops[0]
+                try:
+                    c = int(opstr,0)
+                    if c>127 or c<-128:
+                        print(f"Branch out of range. {c}")
+                        return None
+                except:
+                    relocs.append((target_address,"addrdelta",ops[0]))
+                cc = _baseline_get_cond(instr[1])
+                if not cc:
+                    print(f"Failed to parse condition code '{instr[1]}'. Skipping output for '{filename}'")
+                    return None
+                oc = _baseline_fmt5[instr[0]]
+                val = (oc<<12) | (c<<4) | cc
+            else:
+                print(f"Unknown opcode '{instr[0]}'. Skipping output for '{filename}'.")
+                return None
+            if val != None:
+                outvals.append(val)
+                target_address += 1
+
+    # Apply local relocations.
+    for (tgt,mode,full_valt) in relocs:
+        if full_valt[0:3]=="hi(" or full_valt[0:3]=="lo(":
+            valt = full_valt[3:-1]
+        else:
+            valt = full_valt
+        if valt not in labels:
+            print(f"Attempt to use label '{valt}' not resolved. Skipping output for '{filename}'")
+            return None
+        val = labels[valt]
+        if mode=="word":
+            outvals[tgt] = val
+        elif mode=="lowbyte":
+            outvals[tgt] = (outvals[tgt]&0xff00)|(val&0xff)
+        elif mode=="highbyte":
+            outvals[tgt] = (outvals[tgt]&0xff00)|((val>>8)&0xff)
+        elif mode=="addrdelta":
+            outvals[tgt] = (outvals[tgt]&0xf00f)|(((val-tgt)&0xff)<<4)
+        else:
+            print(f"Failed to apply reloc '{mode}' using '{valt}'. Skipping output for '{filename}'")
+            return None
+    return outvals
+
+
+# A synthetic program: small functions of the sort fjlc writes, with
+# labels, loops, calls, data words and comments.
+def make_source( nlines ):
+    rnd = random.Random(1)
+    regs = [ f"r{n}" for n in range(0,12) ]
+    lines = [ ".org 0" ]
+    fn = 0
+    while len(lines) < nlines:
+        lines.append( f"# function {fn}" )
+        lines.append( f"fn_{fn}:" )
+        lines.append( f"  const   hi(fn_{fn}_data), r1" )
+        lines.append( f"  const   lo(fn_{fn}_data), r1" )
+        lines.append( f"loop_{fn}:" )
+        for i in range(0,rnd.randrange(8,40)):
+            op = rnd.choice( ["add","sub","mov","cmp","and","or","xor","shl","shr","ld","st"] )
+            a = rnd.choice(regs)
+            b = rnd.choice(regs)
+            if op == "ld":
+                lines.append( f"  ld      {a}[{rnd.randrange(0,8)}], {b}" )
+            elif op == "st":
+                lines.append( f"  st      {a}, {b}[{rnd.randrange(0,8)}]" )
+            elif rnd.randrange(0,3) == 0:
+                lines.append( f"  {op:<7} {rnd.randrange(0,16)}, {b}    # constant form" )
+            else:
+                lines.append( f"  {op:<7} {a}, {b}" )
+        lines.append( "  cmp     0, r2" )
+        lines.append( f"  br.{rnd.choice(['E','e','g','G','GE'])}    loop_{fn}" )
+        lines.append( f"  const   hi(fn_{fn+1}), r0" )
+        lines.append( f"  const   lo(fn_{fn+1}), r0" )
+        lines.append( "  call    r0" )
+        lines.append( "  ret     0" )
+        lines.append( "" )
+        lines.append( f"fn_{fn}_data:" )
+        lines.append( f"  .word   fn_{fn}" )
+        lines.append( f"  .word   {rnd.randrange(0,65536)}" )
+        fn += 1
+    lines.append( f"fn_{fn}:" )
+    lines.append( "  halt" )
+    return [ line+"\n" for line in lines ]
+
+def time_assembly( assemble, lines ):
+    start = time.perf_counter()
+    res = assemble( "<bench>", lines )
+    return res, time.perf_counter()-start
+
+def main():
+    nlines = int(sys.argv[1],0) if len(sys.argv) > 1 else 60000
+    lines = make_source( nlines )
+    base, base_secs = min( [ time_assembly(_baseline_do_assembly,lines) for i in range(0,3) ], key=lambda r:r[1] )
+    new, new_secs = min( [ time_assembly(do_assembly,lines) for i in range(0,3) ], key=lambda r:r[1] )
+    for name, secs in [ ("baseline",base_secs), ("current",new_secs) ]:
+        print(f"{name:>10}: {len(lines)} lines in {secs:.3f}s, {len(lines)/secs:.0f} lines/s ({base_secs/secs:.2f}x)")
+    if new == None:
+        print("FAILED: assembly gave no output.")
+        exit(1)
+    if base != new:
+        print("MISMATCH: assembled output differs.")
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#
+# This file is part of the Flapjack assembler
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Constant expressions, as used by fj_as operands and left in relocs for
+# fj_ld. Integers (in any form int(x,0) takes), names, parentheses and,
+# loosest binding last:
+#
+#   - ~ +           unary
+#   * / %
+#   + -
+#   << >>
+#   &
+#   ^
+#   |
+#
+# Names are labels or .equ constants, looked up when the expression is
+# evaluated. Expressions are parsed once and the result kept, as the
+# same ones come up again and again.
+#
+
+import re
+
+_token_re = re.compile( r"\s*(?:(?P<num>0[xX][0-9a-fA-F]+|0[bB][01]+|0[oO][0-7]+|\d+)|(?P<name>[A-Za-z_.$][\w.$@]*)|(?P<op><<|>>|[-+~*/%&^|()]))" )
+
+_binary_ops = [ ["|"], ["^"], ["&"], ["<<",">>"], ["+","-"], ["*","/","%"] ]
+
+
+class ExprError(ValueError):
+    pass
+
+# Raised when evaluating an expression that uses a name the lookup
+# doesn't know.
+class Undefined(Exception):
+    def __init__(self, name):
+        super().__init__(f"'{name}' is not defined")
+        self.name = name
+
+
+def _tokenise( text ):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = _token_re.match( text, pos )
+        if m == None or m.end() == pos:
+            raise ExprError(f"Can't parse expression '{text}'")
+        if m.group("num") != None:
+            tokens.append( ("num",int(m.group("num"),0)) )
+        elif m.group("name") != None:
+            tokens.append( ("name",m.group("name")) )
+        else:
+            tokens.append( ("op",m.group("op")) )
+        pos = m.end()
+    return tokens
+
+# Recursive descent over the tokens, from the loosest binding level.
+# Trees are tuples: ("num",value), ("name",name), (unary op,tree) or
+# (binary op,tree,tree).
+def _parse( tokens, pos, level ):
+    if level == len(_binary_ops):
+        return _parse_unary( tokens, pos )
+    tree, pos = _parse( tokens, pos, level+1 )
+    while pos < len(tokens) and tokens[pos][0] == "op" and tokens[pos][1] in _binary_ops[level]:
+        op = tokens[pos][1]
+        rhs, pos = _parse( tokens, pos+1, level+1 )
+        tree = (op,tree,rhs)
+    return (tree,pos)
+
+def _parse_unary( tokens, pos ):
+    if pos == len(tokens):
+        raise ExprError("Expression ends early")
+    kind, val = tokens[pos]
+    if kind == "op" and val in ["-","~","+"]:
+        tree, pos = _parse_unary( tokens, pos+1 )
+        return ((val,tree),pos)
+    elif kind == "op" and val == "(":
+        tree, pos = _parse( tokens, pos+1, 0 )
+        if pos == len(tokens) or tokens[pos] != ("op",")"):
+            raise ExprError("Missing ')' in expression")
+        return (tree,pos+1)
+    elif kind == "op":
+        raise ExprError(f"Unexpected '{val}' in expression")
+    return ((kind,val),pos+1)
+
+# Parsed expressions, by text.
+_trees = {}
+
+def parse( text ):
+    tree = _trees.get(text)
+    if tree == None:
+        tokens = _tokenise( text )
+        tree, pos = _parse( tokens, 0, 0 )
+        if pos != len(tokens):
+            raise ExprError(f"Can't parse expression '{text}'")
+        _trees[text] = tree
+    return tree
+
+
+def _evaluate( tree, lookup ):
+    kind = tree[0]
+    if kind == "num":
+        return tree[1]
+    elif kind == "name":
+        val = lookup( tree[1] )
+        if val == None:
+            raise Undefined( tree[1] )
+        return val
+    elif len(tree) == 2:
+        val = _evaluate( tree[1], lookup )
+        return -val if kind == "-" else ~val if kind == "~" else val
+    a = _evaluate( tree[1], lookup )
+    b = _evaluate( tree[2], lookup )
+    if kind == "+":
+        return a+b
+    elif kind == "-":
+        return a-b
+    elif kind == "*":
+        return a*b
+    elif kind in ["/","%"]:
+        if b == 0:
+            raise ExprError("Division by zero in expression")
+        return a//b if kind == "/" else a%b
+    elif kind == "<<":
+        return a<<b
+    elif kind == ">>":
+        return a>>b
+    elif kind == "&":
+        return a&b
+    elif kind == "^":
+        return a^b
+    return a|b
+
+# The value of an expression. lookup gives the value of a name, or None
+# if it isn't known, in which case Undefined is raised.
+def evaluate( text, lookup ):
+    return _evaluate( parse(text), lookup )
+
+
+def _names( tree, res ):
+    if tree[0] == "name":
+        res.add( tree[1] )
+    elif tree[0] != "num":
+        for sub in tree[1:]:
+            _names( sub, res )
+    return res
+
+# The names an expression uses.
+def names( text ):
+    return _names( parse(text), set() )
+
+def _text( tree, values ):
+    kind = tree[0]
+    if kind == "num":
+        return str(tree[1])
+    elif kind == "name":
+        val = values.get( tree[1] )
+        return tree[1] if val == None else f"({val})"
+    elif len(tree) == 2:
+        return kind+_text( tree[1], values )
+    return f"({_text(tree[1],values)}{kind}{_text(tree[2],values)})"
+
+# An expression as text without spaces, names in values (a dict of name
+# to expression text) being replaced by their values. A bare name comes
+# back as just the name.
+def canonical( text, values={} ):
+    tree = parse(text)
+    if tree[0] == "name" and tree[1] not in values:
+        return tree[1]
+    res = _text( tree, values )
+    return res[1:-1] if res[0] == "(" and len(tree) == 3 else res
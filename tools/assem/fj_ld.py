@@ -0,0 +1,170 @@
+#
+# This file is part of the Flapjack assembler
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Linker. Takes relocatable objects from fj_as -r and links them into an
+# image in the same forms fj_as writes.
+#
+# Usage: fj_ld.py [-b|-z] [-s] [-o image] <object.rel> ...
+#
+# Sections fixed by .org go where they say. The others are laid out in
+# the order given, from address 0 up, stepping around the fixed ones, so
+# the first object's code is what runs from reset. Each object's relocs
+# are resolved against its own labels first, then against the globals of
+# all the objects.
+#
+#   -b          Write raw little-endian words (.bin) rather than hex (.o).
+#   -z          Write a sparse hex image (see fj_as), gaps left out.
+#   -s          Also write a symbol map (.sym) of every label.
+#   -o image    Output name (default: the first object's, as .o or .bin).
+#
+
+import os
+import sys
+
+from fj_obj import apply_reloc, read_object
+from fj_expr import Undefined, evaluate
+from fj_as import dense_image, write_image, write_sparse, write_symbols
+
+
+# Lay out the sections of all the objects. Returns a list of
+# (object index, section index, address), or None if fixed sections
+# overlap or there's no room.
+def layout( objs ):
+    fixed = []
+    placed = []
+    for oi, obj in enumerate(objs):
+        for si, section in enumerate(obj["sections"]):
+            if section["origin"] != None:
+                fixed.append( (section["origin"],section["origin"]+len(section["words"]),oi,si) )
+                placed.append( (oi,si,section["origin"]) )
+    fixed.sort()
+    for (s1,e1,o1,_), (s2,e2,o2,_) in zip(fixed,fixed[1:]):
+        if s2 < e1:
+            print(f"Fixed sections overlap at {s2:04x}.")
+            return None
+
+    addr = 0
+    for oi, obj in enumerate(objs):
+        for si, section in enumerate(obj["sections"]):
+            if section["origin"] != None:
+                continue
+            size = len(section["words"])
+            moved = True
+            while moved:
+                moved = False
+                for (start,end,_,_) in fixed:
+                    if addr < end and start < addr+size:
+                        addr = end
+                        moved = True
+            if addr+size > 65536:
+                print("Out of memory laying out sections.")
+                return None
+            placed.append( (oi,si,addr) )
+            addr += size
+    return placed
+
+
+# Link objects (with their names, for messages) into a list of
+# (base,words) segments in address order. symbols, if given, gets every
+# label's final address.
+def link( names, objs, symbols=None ):
+    placed = layout( objs )
+    if placed == None:
+        return None
+    bases = dict( [ ((oi,si),addr) for oi, si, addr in placed ] )
+
+    # Final addresses of each object's labels, and of the globals.
+    locals_ = []
+    globals_ = {}
+    for oi, obj in enumerate(objs):
+        own = {}
+        for name, si, offset, is_global in obj["symbols"]:
+            own[name] = bases[(oi,si)]+offset
+            if is_global:
+                if name in globals_:
+                    print(f"Symbol '{name}' defined in both '{globals_[name][1]}' and '{names[oi]}'.")
+                    return None
+                globals_[name] = (own[name],names[oi])
+            if symbols != None:
+                symbols[name if is_global else f"{name}@{os.path.basename(names[oi])}"] = own[name]
+        locals_.append( own )
+
+    for oi, obj in enumerate(objs):
+        def lookup( name ):
+            if name in locals_[oi]:
+                return locals_[oi][name]
+            elif name in globals_:
+                return globals_[name][0]
+            return None
+        for si, offset, mode, name in obj["relocs"]:
+            try:
+                val = evaluate( name, lookup )
+            except Undefined as e:
+                print(f"Undefined symbol '{e.name}' used in '{names[oi]}'.")
+                return None
+            words = obj["sections"][si]["words"]
+            try:
+                words[offset] = apply_reloc( words[offset], mode, val, bases[(oi,si)]+offset )
+            except ValueError as e:
+                print(f"{e} ('{name}' in '{names[oi]}').")
+                return None
+    return sorted( [ (addr,objs[oi]["sections"][si]["words"]) for oi, si, addr in placed if objs[oi]["sections"][si]["words"] ], key=lambda p:p[0] )
+
+
+def main():
+    binary = False
+    sparse = False
+    symmap = False
+    outname = None
+    names = []
+    args = sys.argv[1:]
+    while args != []:
+        arg = args.pop(0)
+        if arg == "-o":
+            if args == []:
+                print(f"Flag {arg} needs a value. Exiting.")
+                exit(1)
+            outname = args.pop(0)
+        elif arg == "-b":
+            binary = True
+        elif arg == "-z":
+            sparse = True
+        elif arg == "-s":
+            symmap = True
+        elif arg[0]=='-':
+            print(f"Unknown flag {arg}. Exiting.")
+            exit(1)
+        else:
+            names.append( arg )
+    if names == []:
+        print("Usage: fj_ld.py [-b|-z] [-s] [-o image] <object.rel> ...")
+        exit(1)
+    if binary and sparse:
+        print("Flags -b and -z can't be used together. Exiting.")
+        exit(1)
+    if outname == None:
+        outname = os.path.splitext(names[0])[0]+(".bin" if binary else ".o")
+
+    try:
+        objs = [ read_object(name) for name in names ]
+    except (OSError,ValueError) as e:
+        print(f"{e}. Exiting.")
+        exit(1)
+    symbols = {}
+    segments = link( names, objs, symbols )
+    if segments == None:
+        print("Link failed.")
+        exit(1)
+    if sparse:
+        write_sparse( outname, segments )
+    else:
+        write_image( outname, dense_image(segments), binary )
+    if symmap:
+        write_symbols( os.path.splitext(outname)[0]+".sym", symbols )
+
+if __name__ == '__main__':
+    main()
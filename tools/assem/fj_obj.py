@@ -0,0 +1,103 @@
+#
+# This file is part of the Flapjack assembler
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Relocatable objects, as written by fj_as -r and read by fj_ld.
+#
+# An object is a dict of:
+#   "sections": list of { "origin": address or None, "words": [...] }
+#               A section with no origin can be placed anywhere.
+#   "symbols":  list of (name, section, offset, is_global)
+#   "relocs":   list of (section, offset, mode, expression)
+#
+# On disk it is text, a line per item:
+#
+#   fjobj 1
+#   section <origin in hex, or *> <word count>
+#   <word in hex>                   one line per word
+#   symbol <name> <section> <offset> global|local
+#   reloc <section> <offset> <mode> <expression>
+#
+# A reloc's expression is most often just a symbol, otherwise an
+# expression over symbols (see fj_expr.py) with no spaces in it.
+#
+# Reloc modes are those the assembler uses internally: word, lowbyte,
+# highbyte and addrdelta.
+#
+
+from fj_expr import parse
+
+OBJ_VERSION = "fjobj 1"
+
+RELOC_MODES = ["word","lowbyte","highbyte","addrdelta"]
+
+
+# The distance from address tgt to address val, as a branch sees it.
+def branch_delta( val, tgt ):
+    return ((val-tgt+32768)&0xffff)-32768
+
+def in_branch_range( delta ):
+    return delta>=-128 and delta<=127
+
+# Apply a reloc of the given mode to word, which sits at address tgt,
+# given the value of the symbol. Returns the new word, or None for a mode
+# that doesn't exist. Raises ValueError for a branch that can't reach.
+def apply_reloc( word, mode, val, tgt ):
+    if mode=="word":
+        return val&0xffff
+    elif mode=="lowbyte":
+        return (word&0xff00)|(val&0xff)
+    elif mode=="highbyte":
+        return (word&0xff00)|((val>>8)&0xff)
+    elif mode=="addrdelta":
+        delta = branch_delta( val, tgt )
+        if not in_branch_range( delta ):
+            raise ValueError(f"Branch at {tgt:04x} can't reach {val:04x}")
+        return (word&0xf00f)|((delta&0xff)<<4)
+    return None
+
+
+def write_object( objname, obj ):
+    out = [ OBJ_VERSION ]
+    for section in obj["sections"]:
+        origin = "*" if section["origin"] == None else f"{section['origin']:04x}"
+        out.append( f"section {origin} {len(section['words'])}" )
+        out += [ f"{w:04x}" for w in section["words"] ]
+    for name, sect, offset, is_global in obj["symbols"]:
+        out.append( f"symbol {name} {sect} {offset} {'global' if is_global else 'local'}" )
+    for sect, offset, mode, name in obj["relocs"]:
+        out.append( f"reloc {sect} {offset} {mode} {name}" )
+    with open(objname,"w") as outfile:
+        outfile.write( "\n".join(out)+"\n" )
+
+# Read an object back. Raises ValueError on anything malformed.
+def read_object( objname ):
+    with open(objname,"r") as infile:
+        lines = [ line.split() for line in infile.readlines() ]
+    if lines == [] or " ".join(lines[0]) != OBJ_VERSION:
+        raise ValueError(f"'{objname}' is not an object file")
+    obj = { "sections": [], "symbols": [], "relocs": [] }
+    pos = 1
+    while pos < len(lines):
+        parts = lines[pos]
+        pos += 1
+        if parts == []:
+            continue
+        elif parts[0] == "section" and len(parts) == 3:
+            count = int(parts[2])
+            words = [ int(line[0],16) for line in lines[pos:pos+count] ]
+            if len(words) != count:
+                raise ValueError(f"'{objname}' ends part way through a section")
+            pos += count
+            obj["sections"].append( { "origin": None if parts[1] == "*" else int(parts[1],16), "words": words } )
+        elif parts[0] == "symbol" and len(parts) == 5:
+            obj["symbols"].append( (parts[1],int(parts[2]),int(parts[3]),parts[4] == "global") )
+        elif parts[0] == "reloc" and len(parts) == 5 and parts[3] in RELOC_MODES:
+            parse( parts[4] )
+            obj["relocs"].append( (int(parts[1]),int(parts[2]),parts[3],parts[4]) )
+        else:
+            raise ValueError(f"'{objname}' line {pos}: can't parse '{' '.join(parts)}'")
+    return obj
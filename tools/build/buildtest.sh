@@ -1,4 +1,2 @@
 #!/bin/bash
-python3 ../comp/fjlc.py simtest.oats >simtest.s
-python3 ../assem/fj_as.py simtest.s
-
+python3 fj_build.py -s -l simtest.oats
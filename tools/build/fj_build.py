@@ -0,0 +1,230 @@
+#
+# This file is part of the Flapjack tool chain
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Build driver. Compiles Oats programs (.oats) to assembler (.s) with
+# fjlc and assembles the result (.o, or .bin with -b) with fj_as, writing
+# both alongside the source. Assembler sources (.s) can be given too.
+#
+# Each stage's output is kept in a content addressed cache, keyed on a
+# hash of the stage, its input, its flags and the source of the tool
+# that runs it. A stage whose key is already in the cache isn't run;
+# its output is copied out of the cache instead. Outputs are only
+# rewritten when they change.
+#
+# Usage: fj_build.py [-j N] [-b] [-s] [-l] [-c cachedir] <source> ...
+#
+#   -j N        Number of worker processes (default 1).
+#   -b          Images as raw little-endian words (.bin) rather than hex (.o).
+#   -s          Also write a symbol map (.sym) for each image.
+#   -l          Also write an assembler listing (.lst) for each image.
+#   -c dir      Cache directory (default $FJ_CACHE, or .fjcache here).
+#
+
+import io
+import os
+import sys
+import hashlib
+import contextlib
+import subprocess
+import multiprocessing
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMP_DIR = os.path.join(TOOLS_DIR,"comp")
+ASSEM_DIR = os.path.join(TOOLS_DIR,"assem")
+
+sys.path.insert(0,ASSEM_DIR)
+
+import fj_as
+
+
+# A hash of a tool's Python source, standing in for its version.
+def tool_version( dirname ):
+    h = hashlib.sha256()
+    for name in sorted(os.listdir(dirname)):
+        if name[-3:] == ".py":
+            with open(os.path.join(dirname,name),"rb") as infile:
+                h.update( name.encode()+b"\0"+infile.read()+b"\0" )
+    return h.hexdigest()
+
+def stage_key( *parts ):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update( part if isinstance(part,bytes) else str(part).encode() )
+        h.update( b"\0" )
+    return h.hexdigest()
+
+
+class Cache():
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def _path( self, key ):
+        return os.path.join(self.dirname,key[0:2],key[2:])
+
+    def get( self, key ):
+        try:
+            with open(self._path(key),"rb") as infile:
+                return infile.read()
+        except OSError:
+            return None
+
+    # Written under a temporary name and renamed, so that a reader in
+    # another process never sees half an entry.
+    def put( self, key, data ):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tmpname = f"{path}.{os.getpid()}.tmp"
+        with open(tmpname,"wb") as outfile:
+            outfile.write(data)
+        os.replace(tmpname,path)
+
+
+# Write a file unless it already holds exactly data.
+def write_if_changed( filename, data ):
+    try:
+        with open(filename,"rb") as infile:
+            if infile.read() == data:
+                return
+    except OSError:
+        pass
+    with open(filename,"wb") as outfile:
+        outfile.write(data)
+
+
+# Oats to assembler. Returns (assembler bytes,ran) or (None,message).
+def compile_stage( cache, version, srcname ):
+    with open(srcname,"rb") as infile:
+        src = infile.read()
+    key = stage_key( "compile", version, src )
+    out = cache.get(key)
+    if out != None:
+        return (out,False)
+    res = subprocess.run( [ sys.executable, os.path.join(COMP_DIR,"fjlc.py"), srcname ],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT )
+    if res.returncode != 0:
+        return (None,res.stdout.decode(errors="replace").strip())
+    cache.put( key, res.stdout )
+    return (res.stdout,True)
+
+# Assembler to image, symbol map and listing. The last two are cheap
+# enough to always make. Returns (image bytes,symbol bytes,listing bytes,
+# ran) or (None,message,None,False).
+def assemble_stage( cache, version, asmname, asm, binary ):
+    key = stage_key( "assemble", version, binary, asm )
+    image = cache.get(key)
+    syms = cache.get(key+"-sym")
+    lst = cache.get(key+"-lst")
+    if image != None and syms != None and lst != None:
+        return (image,syms,lst,False)
+    symbols = {}
+    lines = asm.decode().splitlines(keepends=True)
+    # fj_as reports problems on stdout; catch them for the report.
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        assembly = fj_as.assemble( asmname, lines )
+        segments = fj_as.link_segments( asmname, assembly, symbols ) if assembly != None else None
+    if segments == None:
+        return (None,messages.getvalue().strip(),None,False)
+    image = fj_as.image_bytes( fj_as.dense_image(segments), binary )
+    syms = fj_as.symbols_bytes( symbols )
+    lst = fj_as.listing_bytes( os.path.basename(asmname), lines, assembly )
+    cache.put( key, image )
+    cache.put( key+"-sym", syms )
+    cache.put( key+"-lst", lst )
+    return (image,syms,lst,True)
+
+
+# Build one source. Executes in a worker process. Returns (source,
+# stages run, stages cached, error message or None).
+def build_one( job ):
+    srcname, cachedir, binary, symmap, listing, versions = job
+    cache = Cache(cachedir)
+    base, ext = os.path.splitext(srcname)
+    ran = 0
+    cached = 0
+    try:
+        if ext == ".oats":
+            asm, did = compile_stage( cache, versions["comp"], srcname )
+            if asm == None:
+                return (srcname,ran,cached,did)
+            ran, cached = (ran+1,cached) if did else (ran,cached+1)
+            write_if_changed( base+".s", asm )
+        elif ext == ".s":
+            with open(srcname,"rb") as infile:
+                asm = infile.read()
+        else:
+            return (srcname,ran,cached,"don't know how to build this")
+        image, syms, lst, did = assemble_stage( cache, versions["assem"], base+".s", asm, binary )
+        if image == None:
+            return (srcname,ran,cached,syms)
+        ran, cached = (ran+1,cached) if did else (ran,cached+1)
+        write_if_changed( base+(".bin" if binary else ".o"), image )
+        if symmap:
+            write_if_changed( base+".sym", syms )
+        if listing:
+            write_if_changed( base+".lst", lst )
+    except OSError as e:
+        return (srcname,ran,cached,str(e))
+    return (srcname,ran,cached,None)
+
+
+def main():
+    jobs = 1
+    binary = False
+    symmap = False
+    listing = False
+    cachedir = os.environ.get("FJ_CACHE",".fjcache")
+    sources = []
+    args = sys.argv[1:]
+    while args != []:
+        arg = args.pop(0)
+        if arg in ["-j","-c"]:
+            if args == []:
+                print(f"Flag {arg} needs a value. Exiting.")
+                exit(1)
+            val = args.pop(0)
+            if arg == "-j":
+                jobs = int(val)
+            else:
+                cachedir = val
+        elif arg == "-b":
+            binary = True
+        elif arg == "-s":
+            symmap = True
+        elif arg == "-l":
+            listing = True
+        elif arg[0]=='-':
+            print(f"Unknown flag {arg}. Exiting.")
+            exit(1)
+        else:
+            sources.append( arg )
+    if sources == []:
+        print("Usage: fj_build.py [-j N] [-b] [-s] [-l] [-c cachedir] <source> ...")
+        exit(1)
+
+    versions = { "comp": tool_version(COMP_DIR), "assem": tool_version(ASSEM_DIR) }
+    work = [ (src,cachedir,binary,symmap,listing,versions) for src in sources ]
+    if jobs > 1:
+        with multiprocessing.Pool( jobs ) as pool:
+            results = list( pool.imap( build_one, work ) )
+    else:
+        results = [ build_one(job) for job in work ]
+
+    total_ran = 0
+    total_cached = 0
+    failed = 0
+    for srcname, ran, cached, message in results:
+        total_ran += ran
+        total_cached += cached
+        if message != None:
+            failed += 1
+            print(f"{srcname}: failed: {message}")
+    print(f"Built {len(results)-failed} of {len(results)}: {total_ran} stages run, {total_cached} from cache.")
+    exit( 1 if failed else 0 )
+
+if __name__ == '__main__':
+    main()
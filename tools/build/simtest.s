@@ -1,3 +1,4 @@
+.global main
 main:
   sub 1, sp
   st  ct, sp[0]
@@ -15,6 +16,7 @@ loc_0:
 loc_1:
   ld sp[0], ct
   ret 1
+.global work
 work:
   sub 2, sp
   st  ct, sp[1]
@@ -100,6 +102,7 @@ loc_8:
 loc_10:
   ld sp[1], ct
   ret 2
+.global write_char
 write_char:
   sub 2, sp
   st  ct, sp[1]
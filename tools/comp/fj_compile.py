@@ -53,6 +53,8 @@ def _compile_block( cb, ssa_state, label_state, is_top_level ):
             res += [ IrStep("stack_extend", [IrLoc("c",cb.stackextent)], None ) ]
     for codeline in cb.lines:
         codeline.compiled = None
+        if isinstance(codeline,(Assignment,Return,WhileLoop,IfElse)) and codeline.exp != None:
+            _fold_constants( codeline.exp )
         if isinstance(codeline,Assignment):
             if codeline.name == "_":
                 assigned_var = None
@@ -76,9 +78,6 @@ def _compile_block( cb, ssa_state, label_state, is_top_level ):
                 exp_code = compile_expression(cb,codeline.exp,ssa_state,label_state)
                 codeline.compiled = exp_code+compile_return(codeline.exp.dest_sa,cb.stackextent,False)
         elif isinstance(codeline,WhileLoop):
-            codeline.exp.dest_sa = get_next_sa(ssa_state)
-            exp_code = compile_expression(cb,codeline.exp,ssa_state,label_state)
-            codeline.code_block.stackextent = cb.stackextent
             body_code = _compile_block(codeline.code_block,ssa_state,label_state,False)
             top_label = get_next_label(label_state)
             end_label = get_next_label(label_state)
@@ -86,11 +85,7 @@ def _compile_block( cb, ssa_state, label_state, is_top_level ):
                 # Stack extension goes in here.
                 IrStep("label",[top_label],None)
             ]
-            codeline.compiled += exp_code
-            codeline.compiled += [
-                IrStep("cmp", [IrLoc("c",0),IrLoc("sa",codeline.exp.dest_sa)], None),
-                IrStep("branch_cond", [end_label,IrLoc("cc","eq")], None)
-            ]
+            codeline.compiled += compile_condition(cb,codeline.exp,end_label,ssa_state,label_state)
             codeline.compiled += body_code
             codeline.compiled += [
                 IrStep("branch_cond", [top_label,IrLoc("cc","a")], None),
@@ -98,21 +93,13 @@ def _compile_block( cb, ssa_state, label_state, is_top_level ):
                 # Stack retraction goes in here.
             ]
         elif isinstance(codeline,IfElse):
-            codeline.exp.dest_sa = get_next_sa(ssa_state)
-            exp_code = compile_expression(cb,codeline.exp,ssa_state,label_state)
-            codeline.code_block.stackextent = cb.stackextent
             body_code_if   = _compile_block( codeline.code_block_if,   ssa_state, label_state, False )
             body_code_else = None
             if codeline.code_block_else:
-                codeline.code_block.stackextent = cb.stackextent
                 body_code_else = _compile_block( codeline.code_block_else, ssa_state, label_state, False )
             else_label = get_next_label(label_state)
             end_label = get_next_label(label_state)
-            codeline.compiled  = exp_code
-            codeline.compiled += [
-                IrStep("cmp", [IrLoc("c",0),IrLoc("sa",codeline.exp.dest_sa)], None),
-                IrStep("branch_cond", [else_label,IrLoc("cc","eq")], None)
-            ]
+            codeline.compiled  = compile_condition(cb,codeline.exp,else_label,ssa_state,label_state)
             codeline.compiled += body_code_if
             if body_code_else:
                 codeline.compiled += [
@@ -146,7 +133,7 @@ def compile_expression(cb,exp,ssa_state,label_state):
             exit(1)
         output.append( IrStep("load", [IrLoc("l",idenvar.offset)], IrLoc("sa",exp.dest_sa)) )
     elif exp.operator == ExpNode.LIT:
-        output.append( IrStep("const", [IrLoc("lab",exp.operands[0])],IrLoc("sa",exp.dest_sa)) )
+        output.append( IrStep("const", [IrLoc("c",int(exp.operands[0])&65535)],IrLoc("sa",exp.dest_sa)) )
     elif exp.operator == ExpNode.CALL:
         plist = [ IrLoc("a",exp.operands[0]) ]
         for param in exp.operands[1:]:
@@ -155,38 +142,50 @@ def compile_expression(cb,exp,ssa_state,label_state):
             plist += [ IrLoc("sa",param.dest_sa) ]
         output += [ IrStep("call", plist, IrLoc("sa",exp.dest_sa)) ]
     else:
-        for operand in exp.operands:
-            operand.dest_sa = get_next_sa(ssa_state)
-            operand.code = compile_expression(cb,operand,ssa_state,label_state)
+        # x and y stand for the left and right operands.
+        imm_side = _immediate_side( exp )
+        operand_code, x, y = compile_operands(cb,exp,imm_side,ssa_state,label_state)
+        locs = [x,y]
         if exp.operator.op == "+":
-            nodecode = [ IrStep("add", [IrLoc("sa",exp.operands[0].dest_sa),IrLoc("sa",exp.operands[1].dest_sa)], IrLoc("sa",exp.dest_sa) ) ]
+            if imm_side != None and int(exp.operands[imm_side].operands[0])&65535 >= 16:
+                # Adding 65521 to 65535 is taking away 15 to 1.
+                const = locs[imm_side]
+                const.iden = 65536-const.iden
+                nodecode = [ IrStep("sub", [const,locs[1-imm_side]], IrLoc("sa",exp.dest_sa) ) ]
+            else:
+                nodecode = [ IrStep("add", [x,y] if y.itype=="sa" else [y,x], IrLoc("sa",exp.dest_sa) ) ]
         elif exp.operator.op in ["<<",">>","&","|"]:
             oname = {"<<":"shl",">>":"shr","&":"and","|":"or"}[exp.operator.op]
-            nodecode = [ IrStep(oname, [IrLoc("sa",exp.operands[1].dest_sa),IrLoc("sa",exp.operands[0].dest_sa)], IrLoc("sa",exp.dest_sa) ) ]
+            nodecode = [ IrStep(oname, [y,x] if x.itype=="sa" else [x,y], IrLoc("sa",exp.dest_sa) ) ]
         elif exp.operator.op in ["<",">"]:
             hop_label = get_next_label(label_state)
             if exp.operator.op == ">":
                 compflags = "gt"    # Result is greater-than
             else:
                 compflags = "lt"    # Result is less-than
+            # cmp only takes a constant first, so x op c is done as c op' x.
+            if y.itype == "c":
+                x, y = y, x
+                compflags = {"gt":"lt","lt":"gt"}[compflags]
             nodecode = [
                 IrStep("load", [IrLoc("c",1)], IrLoc("sa",exp.dest_sa)),
-                IrStep("cmp", [IrLoc("sa",exp.operands[0].dest_sa),IrLoc("sa",exp.operands[1].dest_sa)], None ),
+                IrStep("cmp", [x,y], None ),
                 IrStep("branch_cond", [hop_label,IrLoc("cc",compflags)],None),
                 IrStep("load", [IrLoc("c",0)], IrLoc("sa",exp.dest_sa)),
                 IrStep("label",[hop_label],None)
             ]
         elif exp.operator.op=="!=" or exp.operator.op=="==":
             hop_label = get_next_label(label_state)
+            # v1 is kept when the operands are equal.
             if exp.operator.op == "!=":
-                v1 = 1
-                v2 = 0
-            else:
                 v1 = 0
                 v2 = 1
+            else:
+                v1 = 1
+                v2 = 0
             nodecode = [
                 IrStep("load", [IrLoc("c",v1)], IrLoc("sa",exp.dest_sa)),
-                IrStep("cmp", [IrLoc("sa",exp.operands[0].dest_sa),IrLoc("sa",exp.operands[1].dest_sa)], None ),
+                IrStep("cmp", [x,y] if y.itype=="sa" else [y,x], None ),
                 IrStep("branch_cond", [hop_label,IrLoc("cc","eq")],None),
                 IrStep("load", [IrLoc("c",v2)], IrLoc("sa",exp.dest_sa)),
                 IrStep("label",[hop_label],None)
@@ -194,9 +193,128 @@ def compile_expression(cb,exp,ssa_state,label_state):
         else:
             print(f"Encountered unknown operator {exp.operator.op}")
             exit(1)
-        return exp.operands[0].code + exp.operands[1].code + nodecode
+        return operand_code + nodecode
     return output
 
+# Compile the two operands of a binary expression, returning the code and
+# their locations. A small literal operand (the one on imm_side) goes in
+# the instruction, rather than through a register.
+def compile_operands(cb,exp,imm_side,ssa_state,label_state):
+    code = []
+    locs = []
+    for side, operand in enumerate(exp.operands):
+        if side == imm_side:
+            locs.append( IrLoc("c",int(operand.operands[0])&65535) )
+        else:
+            operand.dest_sa = get_next_sa(ssa_state)
+            code += compile_expression(cb,operand,ssa_state,label_state)
+            locs.append( IrLoc("sa",operand.dest_sa) )
+    return (code,locs[0],locs[1])
+
+# Relations of x to y after cmp x, y, as branch_cond condition names: the
+# relation for the comparison operators, each's opposite, and each with x
+# and y swapped. There's no flag condition for x >= y ("nlt").
+_relations = {"<":"lt",">":"gt","==":"eq","!=":"neq"}
+_negated = {"eq":"neq","neq":"eq","gt":"ngt","ngt":"gt","lt":"nlt","nlt":"lt"}
+_mirrored = {"eq":"eq","neq":"neq","gt":"lt","lt":"gt","ngt":"nlt","nlt":"ngt"}
+
+# Compile a condition in control flow position (a while or if): branch to
+# false_label if it's false, and fall through if it's true. A comparison
+# goes straight to a cmp and a branch on the flags, rather than making a
+# 0 or 1 to compare with 0. A literal condition needs no test at all.
+def compile_condition(cb,exp,false_label,ssa_state,label_state):
+    if exp.operator == ExpNode.LIT:
+        if int(exp.operands[0])&65535 != 0:
+            return []
+        return [ IrStep("branch_cond", [false_label,IrLoc("cc","a")], None) ]
+    if not (isinstance(exp.operator,ExpOp) and exp.operator.op in _relations and len(exp.operands) == 2):
+        exp.dest_sa = get_next_sa(ssa_state)
+        return compile_expression(cb,exp,ssa_state,label_state) + [
+            IrStep("cmp", [IrLoc("c",0),IrLoc("sa",exp.dest_sa)], None),
+            IrStep("branch_cond", [false_label,IrLoc("cc","eq")], None)
+        ]
+
+    code, x, y = compile_operands(cb,exp,_immediate_side(exp),ssa_state,label_state)
+    relation = _negated[_relations[exp.operator.op]]
+    # cmp only takes a constant first, and x >= y has to be done as y <= x.
+    if y.itype == "c" or relation == "nlt":
+        x, y = y, x
+        relation = _mirrored[relation]
+    if y.itype == "c" or relation == "nlt":
+        # Can't have both, so the constant goes in a register after all.
+        const = IrLoc("sa",get_next_sa(ssa_state))
+        if x.itype == "c":
+            code.append( IrStep("const", [x], const) )
+            x = const
+        else:
+            code.append( IrStep("const", [y], const) )
+            y = const
+        if relation == "nlt":
+            x, y = y, x
+            relation = _mirrored[relation]
+    return code + [
+        IrStep("cmp", [x,y], None),
+        IrStep("branch_cond", [false_label,IrLoc("cc",relation)], None)
+    ]
+
+# Values of the binary operators on literals, for folding. Everything is
+# 16 bits and unsigned, as on the machine.
+_folds = {
+    "+":  lambda a,b: a+b,
+    "-":  lambda a,b: a-b,
+    "*":  lambda a,b: a*b,
+    "/":  lambda a,b: a//b if b!=0 else None,
+    "&":  lambda a,b: a&b,
+    "|":  lambda a,b: a|b,
+    "<<": lambda a,b: a<<b,
+    ">>": lambda a,b: a>>b,
+    "==": lambda a,b: int(a==b),
+    "!=": lambda a,b: int(a!=b),
+    "<":  lambda a,b: int(a<b),
+    ">":  lambda a,b: int(a>b),
+}
+
+# Operators for which a literal 0 on the right leaves the left as it is.
+_zero_identities = ["+","-","|","<<",">>"]
+
+# Fold constant sub-expressions of an expression tree into literals, in
+# place. Also drops operations with 0 that do nothing.
+def _fold_constants( exp ):
+    if exp.operator == ExpNode.CALL:
+        for param in exp.operands[1:]:
+            _fold_constants( param )
+        return
+    if not isinstance(exp.operator,ExpOp) or len(exp.operands) != 2:
+        return
+    for operand in exp.operands:
+        _fold_constants( operand )
+    lhs, rhs = exp.operands
+    op = exp.operator.op
+    if lhs.operator == ExpNode.LIT and rhs.operator == ExpNode.LIT and op in _folds:
+        value = _folds[op]( int(lhs.operands[0])&65535, int(rhs.operands[0])&65535 )
+        if value != None:
+            exp.operator = ExpNode.LIT
+            exp.operands = [str(value&65535)]
+    elif rhs.operator == ExpNode.LIT and int(rhs.operands[0])&65535 == 0 and op in _zero_identities:
+        exp.operator, exp.operands = lhs.operator, lhs.operands
+    elif lhs.operator == ExpNode.LIT and int(lhs.operands[0])&65535 == 0 and op in ["+","|"]:
+        exp.operator, exp.operands = rhs.operator, rhs.operands
+
+# Which operand of a binary expression (0 or 1) can go in the instruction
+# as a 4 bit constant, or None. Adding 65521 to 65535 counts, as that's a
+# subtraction of 15 to 1. A shift only takes a constant amount.
+def _immediate_side( exp ):
+    op = exp.operator.op
+    if op not in ["+","&","|","<<",">>","<",">","==","!="]:
+        return None
+    for side in [1,0]:
+        operand = exp.operands[side]
+        if operand.operator == ExpNode.LIT and (side == 1 or op not in ["<<",">>"]):
+            value = int(operand.operands[0])&65535
+            if value < 16 or (op == "+" and value > 65520):
+                return side
+    return None
+
 def get_next_sa( ssa_state ):
     res = ssa_state["next"]
     ssa_state["next"]+=1
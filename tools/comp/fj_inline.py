@@ -0,0 +1,232 @@
+# This file is part of the Flapjack language compiler
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+
+#
+# Inline calls to small functions, on the parsed form before layout.
+#
+# A call is inlined by putting the callee's body in front of the
+# statement making it, with its result going through a new local. That
+# moves the call to before anything else in the statement, so only the
+# first call a statement makes (after any calls in its parameters) is
+# taken, then the next, and so on, which keeps calls in the same order.
+# While conditions are left alone, as they're worked out every time
+# round the loop.
+#
+# Parameters given as a literal or a variable are put straight in where
+# they're used, unless the callee assigns to them. Others, and the
+# callee's own locals, become locals of the caller, renamed with an "@"
+# (which can't be in a name in the source) so they don't clash.
+#
+# A function can be inlined if it's no bigger than _max_size (counting
+# statements and expression nodes), ends with its only return and
+# doesn't call itself. Functions are done callees first, so what's
+# inlined has already had its own calls inlined.
+#
+
+from fj_parsed_classes import *
+
+_max_size = 16
+
+def fj_inline( proot ):
+    funcs = { str(entity.name):entity for entity in proot if isinstance(entity,FunctionDef) }
+    state = { "next": 0 }
+    for fd in _callees_first( funcs ):
+        _inline_block( fd.code, funcs, state )
+    return proot
+
+
+# The functions in an order that has callees before their callers, bar
+# recursion.
+def _callees_first( funcs ):
+    order = []
+    seen = set()
+    def visit( name ):
+        seen.add( name )
+        for callee in _calls_in_block( funcs[name].code ):
+            if callee in funcs and callee not in seen:
+                visit( callee )
+        order.append( funcs[name] )
+    for name in funcs:
+        if name not in seen:
+            visit( name )
+    return order
+
+def _calls_in_block( cb ):
+    calls = []
+    for line in _all_lines( cb ):
+        if getattr(line,"exp",None) != None:
+            calls += _calls_in_exp( line.exp )
+    return calls
+
+def _calls_in_exp( exp ):
+    calls = []
+    if exp.operator == ExpNode.CALL:
+        calls.append( str(exp.operands[0]) )
+        operands = exp.operands[1:]
+    elif exp.operator in [ExpNode.IDEN,ExpNode.LIT]:
+        operands = []
+    else:
+        operands = exp.operands
+    for operand in operands:
+        calls += _calls_in_exp( operand )
+    return calls
+
+# Every line in a block and the blocks inside it.
+def _all_lines( cb ):
+    lines = []
+    for line in cb.lines:
+        lines.append( line )
+        for block in _blocks_of( line ):
+            lines += _all_lines( block )
+    return lines
+
+def _blocks_of( line ):
+    if isinstance(line,CodeBlock):
+        return [line]
+    elif isinstance(line,WhileLoop):
+        return [line.code_block]
+    elif isinstance(line,IfElse):
+        return [ block for block in [line.code_block_if,line.code_block_else] if block ]
+    return []
+
+
+def _exp_size( exp ):
+    if exp.operator in [ExpNode.IDEN,ExpNode.LIT]:
+        return 1
+    operands = exp.operands[1:] if exp.operator == ExpNode.CALL else exp.operands
+    return 1+sum( [ _exp_size(operand) for operand in operands ] )
+
+def _size( cb ):
+    size = 0
+    for line in _all_lines( cb ):
+        if not isinstance(line,(LocalVar,CodeBlock)):
+            size += 1
+        if getattr(line,"exp",None) != None:
+            size += _exp_size( line.exp )
+    return size
+
+# Whether a call to fd can be inlined, where the result is used (or not)
+# as given.
+def _inlinable( fd, call, result_used ):
+    lines = fd.code.lines
+    if len(call.operands)-1 != len(fd.params) or lines == [] or not isinstance(lines[-1],Return):
+        return False
+    if len( [ line for line in _all_lines(fd.code) if isinstance(line,Return) ] ) != 1:
+        return False
+    if result_used and lines[-1].exp == None:
+        return False
+    return str(fd.name) not in _calls_in_block( fd.code ) and _size( fd.code ) <= _max_size
+
+
+# Inline the calls that can be in a block and those inside it.
+def _inline_block( cb, funcs, state ):
+    newlines = []
+    for line in cb.lines:
+        for block in _blocks_of( line ):
+            _inline_block( block, funcs, state )
+        if isinstance(line,(Assignment,Return,IfElse)) and line.exp != None:
+            pre, keep = _inline_calls( line, funcs, state )
+            newlines += pre
+            if keep:
+                newlines.append( line )
+        else:
+            newlines.append( line )
+    cb.lines = newlines
+
+# Inline the calls a statement makes first, for as long as they can be.
+# Returns the lines to go in front of it and whether it's still needed.
+def _inline_calls( line, funcs, state ):
+    pre = []
+    while True:
+        call = _first_call( line.exp )
+        if call == None or str(call.operands[0]) not in funcs:
+            return (pre,True)
+        fd = funcs[str(call.operands[0])]
+        whole = call is line.exp
+        # The result of a whole "let _ =" is thrown away.
+        discarded = whole and isinstance(line,Assignment) and line.name == "_"
+        if not _inlinable( fd, call, not discarded and not (whole and isinstance(line,Return)) ):
+            return (pre,True)
+
+        state["next"] += 1
+        tag = f"{fd.name}{state['next']}"
+        body, result = _expand( fd, call.operands[1:], tag )
+        if discarded:
+            # Only kept for the calls it makes, as nothing reads the result.
+            if result != None and _calls_in_exp( result ) != []:
+                body.append( Assignment(line.name,result) )
+            return (pre+body,False)
+        elif whole and isinstance(line,Assignment):
+            body.append( Assignment(line.name,result) )
+            return (pre+body,False)
+        elif whole and isinstance(line,Return):
+            body.append( Return(result) )
+            return (pre+body,False)
+        retname = f"return@{tag}"
+        body += [ LocalVar(retname,fd.return_type), Assignment(retname,result) ]
+        call.operator = ExpNode.IDEN
+        call.operands = [retname]
+        pre += body
+
+# The call an expression makes first: the leftmost one with no calls in
+# its parameters.
+def _first_call( exp ):
+    if exp.operator in [ExpNode.IDEN,ExpNode.LIT]:
+        return None
+    operands = exp.operands[1:] if exp.operator == ExpNode.CALL else exp.operands
+    for operand in operands:
+        call = _first_call( operand )
+        if call != None:
+            return call
+    return exp if exp.operator == ExpNode.CALL else None
+
+# The lines of fd's body for a call with the given parameters, but for
+# its return, and the expression it returns (or None).
+def _expand( fd, params, tag ):
+    assigned = set( [ line.name for line in _all_lines(fd.code) if isinstance(line,Assignment) ] )
+    renames = {}
+    substs = {}
+    lines = []
+    for formal, param in zip(fd.params,params):
+        if param.operator in [ExpNode.IDEN,ExpNode.LIT] and formal.name not in assigned:
+            substs[formal.name] = param
+        else:
+            renames[formal.name] = f"{formal.name}@{tag}"
+            lines += [ LocalVar(renames[formal.name],formal.type), Assignment(renames[formal.name],param) ]
+    for line in _all_lines( fd.code ):
+        if isinstance(line,LocalVar):
+            renames[line.name] = f"{line.name}@{tag}"
+
+    lines += [ _copy_line(line,renames,substs) for line in fd.code.lines[:-1] ]
+    result = fd.code.lines[-1].exp
+    return (lines,_copy_exp(result,renames,substs) if result != None else None)
+
+def _copy_block( cb, renames, substs ):
+    return CodeBlock( [ _copy_line(line,renames,substs) for line in cb.lines ] )
+
+def _copy_line( line, renames, substs ):
+    if isinstance(line,LocalVar):
+        return LocalVar( renames[line.name], line.type )
+    elif isinstance(line,Assignment):
+        return Assignment( renames.get(line.name,line.name), _copy_exp(line.exp,renames,substs) )
+    elif isinstance(line,WhileLoop):
+        return WhileLoop( _copy_exp(line.exp,renames,substs), _copy_block(line.code_block,renames,substs) )
+    elif isinstance(line,IfElse):
+        block_else = _copy_block(line.code_block_else,renames,substs) if line.code_block_else else None
+        return IfElse( _copy_exp(line.exp,renames,substs), _copy_block(line.code_block_if,renames,substs), block_else )
+    elif isinstance(line,CodeBlock):
+        return _copy_block( line, renames, substs )
+    return line
+
+def _copy_exp( exp, renames, substs ):
+    if exp.operator == ExpNode.IDEN:
+        name = exp.operands[0]
+        if name in substs:
+            return _copy_exp( substs[name], {}, {} )
+        return ExpNode( ExpNode.IDEN, [renames.get(name,name)] )
+    elif exp.operator == ExpNode.LIT:
+        return ExpNode( ExpNode.LIT, list(exp.operands) )
+    elif exp.operator == ExpNode.CALL:
+        return ExpNode( ExpNode.CALL, exp.operands[0:1]+[ _copy_exp(operand,renames,substs) for operand in exp.operands[1:] ] )
+    return ExpNode( exp.operator, [ _copy_exp(operand,renames,substs) for operand in exp.operands ] )
@@ -0,0 +1,141 @@
+# This file is part of the Flapjack language compiler
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+
+#
+# Peephole optimisation of each function's assembly, after toasm and
+# before it's printed.
+#
+# Most rules are in the table below: a few consecutive lines matched by
+# regular expressions, a test on what they matched and the lines to put
+# in their place. Lines go one at a time from an input stack to the
+# output, and the rules are tried on the lines just output. When one
+# fires, its replacement goes back on the input, so it gets looked at
+# again along with what came before. Every rule takes lines away, so this
+# gets to a fixed point in one pass, in time linear in the lines.
+#
+# Labels are tidied separately, as that needs the whole function: labels
+# nothing branches to are dropped, and a label directly after another is
+# merged into it. The two alternate until neither finds anything more.
+#
+
+import re
+
+# Registers a function can leave changed: not r0 (the result), sp or ct.
+_scratch_reg = r"(r[1-9]|r1[01])"
+
+# (name, line patterns, test of the matched groups, replacement lines).
+# Groups are numbered across all the patterns, in order. A replacement is
+# either the number of a matched line, to keep it as it was, or a line
+# formatted with the groups ("{0}" and so on). A test of None always
+# passes.
+_rules = [
+    # Moving sp by nothing, as around a call with no parameters.
+    ("sp-by-0",       [ r"(add|sub) 0, sp" ],
+                      None,
+                      []),
+    # Moving sp and straight back.
+    ("sp-undone",     [ r"(add|sub) (\d+), sp", r"(add|sub) (\d+), sp" ],
+                      lambda op1, n1, op2, n2: op1 != op2 and n1 == n2,
+                      []),
+    # A mov and the same mov backwards.
+    ("mov-back",      [ r"mov\s+(\w+), (\w+)", r"mov\s+(\w+), (\w+)" ],
+                      lambda a, b, c, d: a == d and b == c,
+                      [ 0 ]),
+    # A mov to where it's from.
+    ("mov-self",      [ r"mov\s+(\w+), (\w+)" ],
+                      lambda a, b: a == b,
+                      []),
+    # A store and then a load of the same thing into the same register.
+    ("reload",        [ r"st\s+(\w+), (\w+\[\d+\])", r"ld\s+(\w+\[\d+\]), (\w+)" ],
+                      lambda reg1, slot1, slot2, reg2: reg1 == reg2 and slot1 == slot2,
+                      [ 0 ]),
+    # A branch, taken or not, to the very next line.
+    ("br-to-next",    [ r"br\.\w+ (\w+)", r"(\w+):" ],
+                      lambda target, label: target == label,
+                      [ 1 ]),
+    # Code after an unconditional branch or a ret that no label leads to.
+    ("unreachable",   [ r"(br\.a \w+|ret \d+)", r"([^.].*[^:]|[^.])" ],
+                      None,
+                      [ 0 ]),
+    # A register written just before returning, as nothing reads it.
+    ("dead-at-ret",   [ r"(mov|ld|const)\s+[^,]+, "+_scratch_reg, r"ret (\d+)" ],
+                      None,
+                      [ 1 ]),
+    ("dead-at-ret",   [ r"(mov|ld|const)\s+[^,]+, "+_scratch_reg, r"ld\s+(sp\[\d+\]), ct", r"ret (\d+)" ],
+                      None,
+                      [ 1, 2 ]),
+]
+
+_compiled_rules = [ (name,[re.compile(p+"$") for p in patterns],test,replace) for name, patterns, test, replace in _rules ]
+
+
+# A line without its comment and surrounding space, which is what rules
+# match against.
+def _code( line ):
+    return line.split("#")[0].strip()
+
+def _apply_rules( lines, hits ):
+    out = []
+    todo = list(reversed(lines))
+    while todo != []:
+        out.append( todo.pop() )
+        for name, patterns, test, replace in _compiled_rules:
+            n = len(patterns)
+            if len(out) < n:
+                continue
+            groups = []
+            for line, pattern in zip(out[-n:],patterns):
+                m = pattern.match( _code(line) )
+                if m == None:
+                    break
+                groups += m.groups()
+            else:
+                if test == None or test(*groups):
+                    matched = out[-n:]
+                    del out[-n:]
+                    todo += reversed( [ matched[r] if isinstance(r,int) else r.format(*groups) for r in replace ] )
+                    hits[name] = hits.get(name,0)+1
+                    break
+    return out
+
+
+_label_re = re.compile(r"(loc_\d+):$")
+_label_ref_re = re.compile(r"\bloc_\d+\b")
+
+# Drop labels that aren't referred to and merge runs of labels into their
+# first. Only the compiler's own loc_ labels are touched.
+def _tidy_labels( lines, hits ):
+    used = set()
+    for line in lines:
+        if not _label_re.match( _code(line) ):
+            used.update( _label_ref_re.findall( _code(line) ) )
+
+    renames = {}
+    out = []
+    for line in lines:
+        m = _label_re.match( _code(line) )
+        if m:
+            label = m.group(1)
+            if label not in used:
+                hits["label-unused"] = hits.get("label-unused",0)+1
+                continue
+            prev = _label_re.match( _code(out[-1]) ) if out != [] else None
+            if prev:
+                renames[label] = prev.group(1)
+                hits["label-merged"] = hits.get("label-merged",0)+1
+                continue
+        out.append( line )
+
+    if renames != {}:
+        out = [ _label_ref_re.sub( lambda m: renames.get(m.group(0),m.group(0)), line ) for line in out ]
+    return out
+
+# Optimise a function's assembly lines, adding the number of times each
+# rule was used to hits. Returns the new lines.
+def fj_peephole( lines, hits ):
+    while True:
+        before = sum( hits.values() )
+        lines = _tidy_labels( _apply_rules( lines, hits ), hits )
+        if sum( hits.values() ) == before:
+            return lines
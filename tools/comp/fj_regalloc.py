@@ -7,13 +7,20 @@
 # initial stack allocation.
 #
 
+import bisect
+
 from fj_ir_classes import *
 
 
+# The registers values can be given. r12 is ct, which has to survive to
+# the function's ret, and r0 is toasm's scratch register.
+_regs = ["r1","r2","r3","r4","r5","r6","r7","r8","r9","r10","r11"]
+
 def fj_regalloc( func_list ):
     for func in func_list:
         if "ir" in func:
             func["ir"] = _regalloc_func( func )
+    _caller_saves( func_list )
 
 def _regalloc_func( func ):
 
@@ -23,43 +30,152 @@ def _regalloc_func( func ):
     for ir in func["ir"]:
         steplist.append( {"ir":ir} )
 
-    _build_live_list( steplist )
+    _liveness( steplist )
     _reduce_to_2op( steplist )
-    spill_delta = _to_real_reg( steplist, 0 )
-    # TODO
-    # func["next_local"] += spill_delta
+    depth = _locals_depth( steplist, func["stackextent"] )
+    spill_delta = _to_real_reg( steplist, depth )
+    # Spill slots go below the deepest locals, so the frame has to cover
+    # those of nested blocks too.
+    if spill_delta:
+        func["stackextent"] = depth+spill_delta
 
     return steplist
 
 
-# Build the raw ir into a live list for SA targets.
-# This also eliminates SA writes that are never read.
-def _build_live_list( steplist ):
+# How deep the locals go: the function's own plus those of the nested
+# blocks open at the same time.
+def _locals_depth( steplist, stackextent ):
+    depth = stackextent
+    deepest = depth
+    for step in steplist:
+        if step["ir"].op == "stack_extend":
+            depth += step["ir"].srcs[0].iden
+            deepest = max( deepest, depth )
+        elif step["ir"].op == "stack_retract":
+            depth -= step["ir"].srcs[0].iden
+    return deepest
 
-    proglist = []
-    livelist = set()
-    lastreads = {}
 
+# Split the steps into basic blocks. Returns a list of (first,last) step
+# indices and the successors of each, as block numbers.
+def _flow_graph( steplist ):
+    labels = {}
+    leaders = set([0])
     for index, step in enumerate(steplist):
-        dst = step["ir"].dst
-        if dst and dst.itype == "sa":
-            livelist.add(dst.iden)
-        step["livesa"] = livelist.copy()
-        for src in step["ir"].srcs:
-            if src and src.itype == "sa":
-                lastreads[src.iden] = index
+        op = step["ir"].op
+        if op == "label":
+            labels[step["ir"].srcs[0].iden] = index
+            leaders.add( index )
+        elif op in ["branch_cond","ret"]:
+            leaders.add( index+1 )
+    leaders = sorted( [ leader for leader in leaders if leader < len(steplist) ] )
+    blockat = { leader:n for n, leader in enumerate(leaders) }
+
+    blocks = []
+    succs = []
+    for n, first in enumerate(leaders):
+        last = leaders[n+1]-1 if n+1 < len(leaders) else len(steplist)-1
+        blocks.append( (first,last) )
+        ir = steplist[last]["ir"]
+        out = []
+        if ir.op == "branch_cond":
+            out.append( blockat[labels[ir.srcs[0].iden]] )
+        falls = ir.op != "ret" and not (ir.op == "branch_cond" and ir.srcs[1].iden == "a")
+        if falls and n+1 < len(leaders):
+            out.append( n+1 )
+        succs.append( out )
+    return (blocks,succs)
+
+# Liveness of the SAs over the flow graph, so values live round a while
+# loop's back edge stay live over all of it. Solved per basic block, then
+# each block is walked once, which keeps it linear in the number of steps
+# for the code the compiler generates.
+# Returns the live interval of each SA, as [first,last] step indices (the
+# span in step order of everywhere it's live), and the steps that read
+# each. Also marks each step with the SAs whose last read it is ("dies"),
+# and turns writes of SAs never read into nops.
+def _liveness( steplist ):
+    blocks, succs = _flow_graph( steplist )
+    preds = [ [] for block in blocks ]
+    for n, out in enumerate(succs):
+        for succ in out:
+            preds[succ].append( n )
+
+    # The SAs each block reads before writing, and those it writes.
+    uses = []
+    defs = []
+    for first, last in blocks:
+        use = set()
+        written = set()
+        for index in range(last,first-1,-1):
+            ir = steplist[index]["ir"]
+            if ir.dst and ir.dst.itype == "sa":
+                use.discard( ir.dst.iden )
+                written.add( ir.dst.iden )
+            for src in ir.srcs:
+                if src and src.itype == "sa":
+                    use.add( src.iden )
+        uses.append( use )
+        defs.append( written )
 
+    livein = [ set() for block in blocks ]
+    liveout = [ set() for block in blocks ]
+    # Last block first, as liveness flows backwards.
+    worklist = list(range(len(blocks)))
+    pending = set(worklist)
+    while worklist != []:
+        n = worklist.pop()
+        pending.discard( n )
+        liveout[n] = set().union( *[ livein[succ] for succ in succs[n] ] )
+        newin = uses[n] | (liveout[n]-defs[n])
+        if newin != livein[n]:
+            livein[n] = newin
+            for pred in preds[n]:
+                if pred not in pending:
+                    pending.add( pred )
+                    worklist.append( pred )
+
+    intervals = {}
+    def extend( sa, index ):
+        interval = intervals.get(sa)
+        if interval == None:
+            intervals[sa] = [index,index]
+        elif index < interval[0]:
+            interval[0] = index
+        elif index > interval[1]:
+            interval[1] = index
+
+    for n, (first, last) in enumerate(blocks):
+        live = set(liveout[n])
+        for sa in live:
+            extend( sa, last )
+        for index in range(last,first-1,-1):
+            ir = steplist[index]["ir"]
+            dst = ir.dst
+            if dst and dst.itype == "sa":
+                if dst.iden in live:
+                    live.remove( dst.iden )
+                    extend( dst.iden, index )
+                else:
+                    dst.itype = "nop"
+                    dst.iden = None
+            dies = set()
+            for src in ir.srcs:
+                if src and src.itype == "sa":
+                    if src.iden not in live:
+                        dies.add( src.iden )
+                        live.add( src.iden )
+                    extend( src.iden, index )
+            steplist[index]["dies"] = dies
+        for sa in live:
+            extend( sa, first )
+
+    reads = {}
     for index, step in enumerate(steplist):
-        dst = step["ir"].dst
-        if dst and dst.itype == "sa":
-            if (dst.iden not in lastreads) or index >= lastreads[dst.iden]:
-                dst.itype = 'nop'
-                dst.iden = None
-        new_set = set()
-        for sa in step["livesa"]:
-            if (sa in lastreads) and (index <= lastreads[sa]):
-                new_set.add(sa)
-        step["livesa"] = new_set
+        for src in step["ir"].srcs:
+            if src and src.itype == "sa":
+                reads.setdefault( src.iden, [] ).append( index )
+    return (intervals,reads)
 
 # Optimisation: for a 2-op machine eliminate cases where f(a,b)->c could
 # be expressed as f(a,b)->b because b ceases to be live. Otherwise we'll need
@@ -69,11 +185,10 @@ def _build_live_list( steplist ):
 def _reduce_to_2op( steplist ):
 
     renumbernotes = {}
-    step = None
-    for nextstep in steplist:
-        if step == None:
-            step = nextstep
-            continue
+    for step in steplist:
+        # Whether the second source dies here goes by its original SA.
+        src2 = step["ir"].srcs[1] if len(step["ir"].srcs) > 1 else None
+        src2_dies = src2 != None and src2.itype == "sa" and src2.iden in step["dies"]
         # Do the renumber first.
         dst = step["ir"].dst
         if dst and dst.itype == "sa":
@@ -81,58 +196,176 @@ def _reduce_to_2op( steplist ):
         for src in step["ir"].srcs:
             if src and src.itype == "sa":
                 src.iden = renumbernotes.get(src.iden,src.iden)
-        livecopy = set(step["livesa"])
-        for sa in livecopy:
-            if sa in renumbernotes:
-                step["livesa"].remove(sa)
         # Then mutate on a per-op basis.
         if step["ir"].op in ["add","sub","or","and","shl","shr"]:
-            if step["ir"].srcs[1].itype=="sa" and step["ir"].dst.itype=="sa" and step["ir"].srcs[1].iden not in nextstep["livesa"]:
+            if step["ir"].srcs[1].itype=="sa" and step["ir"].dst.itype=="sa" and src2_dies:
                 renumbernotes[step["ir"].dst.iden] = step["ir"].srcs[1].iden
-                step["livesa"].remove( step["ir"].dst.iden )
                 step["ir"].dst.iden = step["ir"].srcs[1].iden
 
-        # This must always happen i.e. no continue-ing.
-        step = nextstep
 
-
-# Replace SA references to real register number (ir changes from "sa" to "r".
-# It relies on the principle that once an SA is out of the liveset, it never returns.
+# Replace SA references with real registers (itype "sa" becomes "r"), by
+# linear scan over the live interval of each SA: an SA gets a register
+# when first written and gives it up after its last read.
+# When the registers run out, the SA read again furthest in the future is
+# spilled: it gets a stack slot, is stored there when written and
+# reloaded into a new, short lived SA before each read. The scan is then
+# run again, until nothing more needs spilling.
+# Spill slots go below next_local_index words of locals. Returns the
+# number of slots added.
 # There is knowlege of the target system embedded in here, which should really be externalised.
 def _to_real_reg( steplist, next_local_index ):
 
     spill_delta = 0
 
-    regs = ["r1","r2","r3","r4","r5","r6","r7","r8","r9","r10","r11","r12"]
+    # The SAs made for reloads, which there's no point spilling.
+    reloads = set()
+    while True:
+        intervals, reads = _liveness( steplist )
+        assignment, across, spills = _linear_scan( steplist, intervals, reads, _regs, reloads )
+        if spills == set():
+            break
+        spill_delta += _insert_spills( steplist, spills, intervals, next_local_index+spill_delta,
+                                       max(intervals)+1, reloads )
+
+    for step, stepacross in zip(steplist,across):
+        step["across"] = stepacross
+        for item in step["ir"].srcs+[step["ir"].dst]:
+            if item and item.itype=="sa":
+                item.itype="r"
+                item.iden = assignment[item.iden]
+
+    return spill_delta
+
+# One pass of the linear scan. Returns the register for each SA, the
+# registers holding values live across each step (read after it, and
+# written before it) and the SAs to spill (the first two only meaning
+# anything if there are none of those).
+def _linear_scan( steplist, intervals, reads, regs, reloads ):
 
     # Mapping from SA to reg and remaining free regs.
     smap = {}
     freeregs = regs.copy()
+    assignment = {}
+    across = []
+    spills = set()
 
-    for step in steplist:
+    # SAs live into a loop before being written in it need their register
+    # from the start of their interval, not where they first turn up.
+    starts = {}
+    for sa, (start, end) in intervals.items():
+        starts.setdefault( start, [] ).append( sa )
+
+    for index, step in enumerate(steplist):
         # First, unallocate any registers no longer needed.
         newmap = {}
         for sa in smap:
-            if sa in step["livesa"]:
+            if intervals[sa][1] >= index:
                 newmap[sa] = smap[sa]
             else:
                 freeregs = [smap[sa]]+freeregs
         smap = newmap
-        step["inuse"] = smap.values()
-        for item in step["ir"].srcs+[step["ir"].dst]:
-            if item and item.itype=="sa":
-                sa = item.iden
-                if sa not in smap:
-                    newreg = "ERROR"
-                    if regs!=[]:
-                        newreg = freeregs[0]
-                        freeregs = freeregs[1:]
-                    else:
-                        # Need to spill TBD
-                        newreg = "ERROR"
-                    smap[item.iden] = newreg
-                item.itype="r"
-                item.iden = smap[sa]
+        items = [ item.iden for item in step["ir"].srcs+[step["ir"].dst] if item and item.itype=="sa" ]
+        items += sorted( [ sa for sa in starts.get(index,[]) if sa not in items ] )
+        for sa in items:
+            if sa in smap or sa in spills:
+                continue
+            if freeregs == []:
+                # Spill whichever of this SA and those holding registers
+                # (bar any this step needs) is next read the latest.
+                needed = set( items )
+                candidates = [ c for c in [sa]+list(smap) if c not in reloads and (c == sa or c not in needed) ]
+                if candidates == []:
+                    print(f"Too many values needed at once by {step['ir'].pretty()}")
+                    exit(1)
+                victim = max( candidates, key=lambda c:( _next_read(reads[c],index), c ) )
+                spills.add( victim )
+                if victim != sa:
+                    smap[sa] = smap.pop(victim)
+                    assignment[sa] = smap[sa]
+                continue
+            smap[sa] = freeregs[0]
+            freeregs = freeregs[1:]
+            assignment[sa] = smap[sa]
+        across.append( sorted( [ smap[sa] for sa in smap if intervals[sa][0] < index < intervals[sa][1] ], key=lambda reg:int(reg[1:]) ) )
 
-    return spill_delta
+    return (assignment,across,spills)
+
+# The first of reads (ascending step indices) after index.
+def _next_read( reads, index ):
+    return reads[ bisect.bisect_right( reads, index ) ] if reads[-1] > index else index
+
+# Give each spilled SA a stack slot, sharing slots between SAs whose
+# intervals don't overlap, and rewrite the steps to store each to its
+# slot when written and reload it into a new SA before each read.
+# Returns the number of slots used.
+def _insert_spills( steplist, spills, intervals, next_local_index, next_sa, reloads ):
+    slots = {}
+    slot_ends = []
+    for sa in sorted( spills, key=lambda sa:intervals[sa][0] ):
+        start, end = intervals[sa]
+        for n, slot_end in enumerate(slot_ends):
+            if slot_end < start:
+                break
+        else:
+            n = len(slot_ends)
+            slot_ends.append( end )
+        slot_ends[n] = end
+        # Locals are at negative offsets, so slots are at those beyond them.
+        slots[sa] = -(next_local_index+1+n)
+
+    newlist = []
+    for step in steplist:
+        ir = step["ir"]
+        temps = {}
+        for src in ir.srcs:
+            if src and src.itype == "sa" and src.iden in spills:
+                if src.iden not in temps:
+                    temps[src.iden] = next_sa
+                    reloads.add( next_sa )
+                    newlist.append( {"ir":IrStep("load",[IrLoc("l",slots[src.iden])],IrLoc("sa",next_sa))} )
+                    next_sa += 1
+                src.iden = temps[src.iden]
+        newlist.append( step )
+        dst = ir.dst
+        if dst and dst.itype == "sa" and dst.iden in spills:
+            spilled = dst.iden
+            if spilled not in temps:
+                temps[spilled] = next_sa
+                reloads.add( next_sa )
+                next_sa += 1
+            dst.iden = temps[spilled]
+            newlist.append( {"ir":IrStep("store",[IrLoc("sa",dst.iden)],IrLoc("l",slots[spilled]))} )
+    steplist[:] = newlist
+    return len(slot_ends)
+
+
+# Work out the registers each function may change, by its own code or the
+# functions it calls, and from those the registers each call has to save
+# ("saves"): the ones holding values live across it that the callee may
+# change. Functions not compiled here (those in _asm, say) are taken to
+# change them all.
+def _caller_saves( func_list ):
+    allregs = set(_regs)
+    funcs = { func["name"]:func for func in func_list if "ir" in func }
+    clobbers = {}
+    callees = {}
+    for name, func in funcs.items():
+        clobbers[name] = set( [ step["ir"].dst.iden for step in func["ir"] if step["ir"].dst and step["ir"].dst.itype == "r" ] )
+        callees[name] = set( [ step["ir"].srcs[0].iden for step in func["ir"] if step["ir"].op == "call" ] )
+
+    # Calls can be recursive, so go round until nothing changes.
+    changed = True
+    while changed:
+        changed = False
+        for name in funcs:
+            for callee in callees[name]:
+                extra = clobbers.get(callee,allregs)-clobbers[name]
+                if extra:
+                    clobbers[name] |= extra
+                    changed = True
 
+    for func in funcs.values():
+        for step in func["ir"]:
+            if step["ir"].op == "call":
+                changes = clobbers.get(step["ir"].srcs[0].iden,allregs)
+                step["saves"] = [ reg for reg in step["across"] if reg in changes ]
@@ -7,40 +7,76 @@
 #
 
 def fj_toasm( entity_list ):
+    for entity in entity_list:
+        if entity["name"] != "__litasm":
+            entity["asm"] = _toasm_func( entity["name"], entity["ir"], entity["stackextent"] )
+    
+    return []
+
+# Print the assembly for everything, in order.
+def fj_print_asm( entity_list ):
     for entity in entity_list:
         if entity["name"] == "__litasm":
             print(entity["litstr"][1:-1])
         else:
-            entity["asm"] = _toasm_func( entity["name"], entity["ir"], entity["stackextent"] )
             for instr in entity["asm"]:
                 print(instr)
-    
-    return []
+
+# Operand for the stack word offset words above sp. ld and st only have
+# room for offsets up to 7, so further out the address is put together in
+# r0 first, which is never holding anything between IR steps.
+def _stack_ref( lines, offset ):
+    if offset < 8:
+        return f"sp[{offset}]"
+    elif offset < 23:
+        lines.append(f"  mov sp, r0")
+        lines.append(f"  add {offset-7}, r0")
+        return "r0[7]"
+    lines.append(f"  const hi({offset}), r0")
+    lines.append(f"  const lo({offset}), r0")
+    lines.append(f"  add sp, r0")
+    return "r0[0]"
+
+# Move sp by n words, op being "add" or "sub". The immediate is 4 bits, so
+# larger moves go through r0.
+def _move_sp( lines, op, n ):
+    if n < 16:
+        lines.append(f"  {op} {n}, sp")
+    else:
+        lines.append(f"  const hi({n}), r0")
+        lines.append(f"  const lo({n}), r0")
+        lines.append(f"  {op} r0, sp")
 
 def _toasm_func( funcname, funcir, initial_stack_extent ):
 
+    # A leaf function leaves ct alone, so needn't save it. Its slot is kept
+    # so the frame is laid out the same.
+    leaf = not any( [ step["ir"].op == "call" for step in funcir ] )
+
     lines = [
+        f".global {funcname}",
         f"{funcname}:",
-        f"  sub {initial_stack_extent+1}, sp",
-        f"  st  ct, sp[{initial_stack_extent}]" # Only necessary for non-leaf functions.
     ]
+    _move_sp( lines, "sub", initial_stack_extent+1 )
+    if not leaf:
+        lines.append(f"  st  ct, {_stack_ref(lines,initial_stack_extent)}")
 
     stack_offset = initial_stack_extent
     for step in funcir:
         stepir = step["ir"]
         if stepir.op=="stack_extend":
             src = stepir.srcs[0]
-            lines.append(f"  sub {src.iden}, sp")
+            _move_sp( lines, "sub", src.iden )
             stack_offset += src.iden
         elif stepir.op=="stack_retract":
             src = stepir.srcs[0]
-            lines.append(f"  add {src.iden}, sp")
+            _move_sp( lines, "add", src.iden )
             stack_offset -= src.iden
         elif stepir.op == "load":
             src = stepir.srcs[0]
             dst = stepir.dst
             if src.itype=="l" and dst.itype=="r":
-                lines.append(f"  ld  sp[{stack_offset+src.iden}], {dst.iden}   # stack_offset={stack_offset}, src.iden={src.iden}")
+                lines.append(f"  ld  {_stack_ref(lines,stack_offset+src.iden)}, {dst.iden}   # stack_offset={stack_offset}, src.iden={src.iden}")
             elif src.itype=="c" and dst.itype=="r":
                 lines.append(f"  mov  {src.iden}, {dst.iden}")
             else:
@@ -49,36 +85,36 @@ def _toasm_func( funcname, funcir, initial_stack_extent ):
             src = stepir.srcs[0]
             dst = stepir.dst
             if src.itype=="r" and dst.itype=="l":
-                lines.append(f"  st  {src.iden}, sp[{stack_offset+dst.iden}]")
+                lines.append(f"  st  {src.iden}, {_stack_ref(lines,stack_offset+dst.iden)}")
             else:
                 lines.append(f"  BAD STORE: {stepir.pretty()}")
         elif stepir.op == "call":
             param_count = len(stepir.srcs[1:])
-            savelist = [ save for save in  list(step["inuse"]) if save not in [p.iden for p in stepir.srcs[1:]] ]
+            savelist = step["saves"]
             pushlist = savelist + [param.iden for param in stepir.srcs[1:] ]
-            lines.append(f"  sub {len(pushlist)}, sp");
+            _move_sp( lines, "sub", len(pushlist) )
             for i,push in enumerate(pushlist):
-                lines.append(f"  st {push}, sp[{len(pushlist)-(i+1)}]")
+                lines.append(f"  st {push}, {_stack_ref(lines,len(pushlist)-(i+1))}")
             lines.append(f"  const hi({stepir.srcs[0].iden}), r0")
             lines.append(f"  const lo({stepir.srcs[0].iden}), r0")
             lines.append(f"  call r0")
-            savelist.reverse()
-            for i,save in enumerate(savelist):
-                lines.append(f"  ld {save}, sp[{len(pushlist)-(i+1)}]")
-            lines.append(f"  add {len(pushlist)}, sp");
+            # Take the result out of r0 first, as the restores may need it.
             if stepir.dst.iden:
                 lines.append(f"  mov r0, {stepir.dst.iden}")
-        elif stepir.op == "add":
+            for i,save in enumerate(savelist):
+                lines.append(f"  ld {_stack_ref(lines,len(pushlist)-(i+1))}, {save}")
+            _move_sp( lines, "add", len(pushlist) )
+        elif stepir.op in ["add","sub"]:
             src1 = stepir.srcs[0]
             src2 = stepir.srcs[1]
             dst = stepir.dst
             if src2.itype=="r" and dst.itype=="r" and src2.iden != dst.iden:
                 lines.append(f"  BAD 3OP")
             else:
-                if src1.itype=="r" and dst.itype=="r":
-                    lines.append(f"  add  {src1.iden}, {dst.iden}")
+                if src1.itype in ["r","c"] and dst.itype=="r":
+                    lines.append(f"  {stepir.op}  {src1.iden}, {dst.iden}")
                 else:
-                    lines.append(f"  BAD ADD: {stepir.pretty()}")
+                    lines.append(f"  BAD {stepir.op.upper()}: {stepir.pretty()}")
         elif stepir.op in ["shl","shr","and","or"]:
             src1 = stepir.srcs[0]
             src2 = stepir.srcs[1]
@@ -96,14 +132,16 @@ def _toasm_func( funcname, funcir, initial_stack_extent ):
             if stack_offset != initial_stack_extent:
                 lines.append("  BAD RET: mid func exit")
             else:
+                # ct first, while r0 is free for the address.
+                if not leaf:
+                    lines.append(f"  ld {_stack_ref(lines,initial_stack_extent)}, ct")
                 src = stepir.srcs[0]
                 if src:
                     if src.itype=="r":
                         lines.append(f"  mov  {src.iden}, r0")
                     else:
                         lines.append(f"  BAD RET: {stepir.pretty()}")
-                lines.append(f"  ld sp[{initial_stack_extent}], ct")
-                lines.append(f"  ret {stepir.srcs[1].iden+1}")
+                lines.append(f"  ret {initial_stack_extent+1}")
         elif stepir.op == "const":
             src = stepir.srcs[0]
             dst = stepir.dst
@@ -9,13 +9,43 @@
 import sys
 
 from fj_parser import fj_parser
+from fj_inline import fj_inline
 from fj_layout import fj_layout
 from fj_compile import fj_compile
 from fj_regalloc import fj_regalloc
-from fj_toasm import fj_toasm
+from fj_toasm import fj_toasm, fj_print_asm
+from fj_peephole import fj_peephole
 
+# Usage: fjlc.py [-p] [-P] [-I] <source.oats>
+#
+#   -p          Print how often each peephole rule was used, on stderr.
+#   -P          Don't run the peephole optimiser.
+#   -I          Don't inline small functions.
+#
 def main():
-    with open(sys.argv[1],"r") as infile:
+    filename = None
+    peephole = True
+    peephole_stats = False
+    inline = True
+    args = sys.argv[1:]
+    while args != []:
+        arg = args.pop(0)
+        if arg == "-p":
+            peephole_stats = True
+        elif arg == "-P":
+            peephole = False
+        elif arg == "-I":
+            inline = False
+        elif arg[0]=='-':
+            print(f"Unknown flag {arg}. Exiting.")
+            exit(1)
+        else:
+            filename = arg
+    if filename == None:
+        print("Usage: fjlc.py [-p] [-P] [-I] <source.oats>")
+        exit(1)
+
+    with open(filename,"r") as infile:
         inlines = "\n".join(infile.readlines())
     try:
         objform = fj_parser( inlines )
@@ -23,10 +53,21 @@ def main():
         print("Exception parsing input.")
         print(e)
         exit(1)
+    if inline:
+        fj_inline( objform )                # Put small functions in where they're called
     fj_layout( objform )                    # Setup home locations for params and locals
     ir_list = fj_compile( objform )         # Compile to IR
     fj_regalloc( ir_list )        # Allocated register, inject spills and stack allocs.
     out = fj_toasm( ir_list )               # Transform IR to assembly
+    hits = {}
+    if peephole:
+        for entity in ir_list:
+            if "asm" in entity:
+                entity["asm"] = fj_peephole( entity["asm"], hits )    # Tidy up the assembly
+    fj_print_asm( ir_list )
+    if peephole_stats:
+        for name in sorted(hits):
+            print(f"{name:16} {hits[name]}",file=sys.stderr)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,124 @@
+#
+# This file is part of the Flapjack instruction level simulator
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Batch runner. Simulates many images across a pool of processes, each
+# under an instruction budget, and writes a tab separated results table
+# with one row per image: halt reason, instruction count, wall time and
+# final registers.
+#
+# Usage: fj_batch.py [-j N] [-n budget] [-t secs] [-i] [-o results.tsv] <source> ...
+#
+# A source is either a directory, in which case every .o and .bin in it
+# is run, or a manifest file listing one image per line (relative to the
+# manifest), optionally followed by a per-image budget. Blank lines and
+# anything after a '#' are ignored.
+#
+#   -j N        Number of worker processes (default: one per CPU).
+#   -n budget   Default instruction budget per image (default 10000000).
+#   -t secs     Wall clock limit per image (default none).
+#   -i          Interpreter only; don't use the block engine.
+#   -o file     Write the table to file rather than stdout.
+#
+
+import os
+import sys
+import time
+import multiprocessing
+
+import fj_io
+import fj_sim
+
+DEFAULT_BUDGET = 10_000_000
+
+
+# Expand a directory or manifest into a list of (image,budget) pairs.
+def collect_images( source, default_budget ):
+    if os.path.isdir(source):
+        names = sorted( [ n for n in os.listdir(source) if n[-2:] == ".o" or n[-4:] == ".bin" ] )
+        return [ (os.path.join(source,n),default_budget) for n in names ]
+    res = []
+    basedir = os.path.dirname(source)
+    with open(source,"r") as infile:
+        for line in infile.readlines():
+            parts = line.split('#')[0].split()
+            if parts == []:
+                continue
+            budget = int(parts[1],0) if len(parts) > 1 else default_budget
+            res.append( (os.path.join(basedir,parts[0]),budget) )
+    return res
+
+
+# Run one image. Executes in a worker process.
+def run_image( job ):
+    image, budget, timeout, use_blocks = job
+    start = time.perf_counter()
+    try:
+        # Output goes nowhere: an empty bus.
+        m = fj_sim.Machine( fj_io.IoBus() )
+        m.load( image )
+        m.run( max_steps=budget, timeout=timeout, use_blocks=use_blocks )
+    except Exception as e:
+        return (image, f"error: {e}", 0, time.perf_counter()-start, None)
+    return (image, m.halt_reason, m.steps, time.perf_counter()-start, list(m.regs))
+
+
+def format_row( res ):
+    image, reason, steps, secs, regs = res
+    regcols = [ f"{x:04x}" for x in regs ] if regs != None else [ "" ]*16
+    return "\t".join( [ image, reason, str(steps), f"{secs:.4f}" ] + regcols )
+
+def main():
+    jobs = None
+    budget = DEFAULT_BUDGET
+    timeout = None
+    use_blocks = True
+    outname = None
+    sources = []
+    args = sys.argv[1:]
+    while args != []:
+        arg = args.pop(0)
+        if arg in ["-j","-n","-t","-o"]:
+            if args == []:
+                print(f"Flag {arg} needs a value. Exiting.")
+                exit(1)
+            val = args.pop(0)
+            if arg == "-j":
+                jobs = int(val)
+            elif arg == "-n":
+                budget = int(val,0)
+            elif arg == "-t":
+                timeout = float(val)
+            else:
+                outname = val
+        elif arg == "-i":
+            use_blocks = False
+        elif arg[0]=='-':
+            print(f"Unknown flag {arg}. Exiting.")
+            exit(1)
+        else:
+            sources.append( arg )
+
+    images = []
+    for source in sources:
+        images += collect_images( source, budget )
+    work = [ (image,ibudget,timeout,use_blocks) for (image,ibudget) in images ]
+
+    header = "\t".join( ["image","halt","steps","secs"] + [ f"r{n}" for n in range(0,16) ] )
+    outfile = open(outname,"w") if outname else sys.stdout
+    failed = 0
+    with multiprocessing.Pool( jobs ) as pool:
+        outfile.write(header+"\n")
+        for res in pool.imap( run_image, work ):
+            if res[4] == None:      # Failed to run at all.
+                failed += 1
+            outfile.write(format_row(res)+"\n")
+    if outfile != sys.stdout:
+        outfile.close()
+    exit( 1 if failed else 0 )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#
+# This file is part of the Flapjack instruction level simulator
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Basic block translator. A straight line run of instructions starting
+# at a given address, up to and including the first jp, br, call or ret,
+# is turned into Python source for a single function, which is then
+# compiled. Registers live in locals for the duration of the block, and
+# a block whose closing branch targets its own start loops internally.
+#
+# The generated function is called as f(R,M,C,I,O) where R is the register
+# file, M memory, C the map of addresses holding cached code, I the
+# function that invalidates an address and O the IO bus write. It returns the number of
+# instructions executed, and always leaves IP at the next instruction.
+# Register values are always 16 bit, so only writes are masked.
+#
+
+IP = 15
+SP = 14
+FL = 13
+CT = 12
+
+# Longest run compiled into a single block.
+MAX_BLOCK = 64
+
+# A block that branches back to its own start loops internally, for up to
+# this many instructions per call.
+MAX_LOOP = 1024
+
+
+# Python expression for a s/fff condition field against the flags local.
+def _cond_expr( cond ):
+    m = cond&6
+    if cond&8:
+        # All the named flags set (bit 0 is always set).
+        return "True" if m==0 else f"(r{FL}&{m})=={m}"
+    else:
+        # None of the named flags set (bit 0 is always set).
+        if cond&1:
+            return "False"
+        return "True" if m==0 else f"not (r{FL}&{m})"
+
+
+# Source operand 1 as an expression: either the small constant or a register.
+def _src( reg, mode, ip ):
+    if mode:
+        return str(reg)
+    if reg == IP:
+        return str(ip)
+    return f"r{reg}"
+
+def _reg( reg, ip ):
+    return str(ip) if reg == IP else f"r{reg}"
+
+
+# Produce the body lines, the set of registers touched and the set of
+# registers written for the single instruction at ip. Returns None if the
+# instruction can't live in a block (it halts, or writes IP directly).
+# The fourth element is true for an instruction that ends a block. A
+# branch adds a fifth: its target and condition expression.
+def _translate_instr( instr, ip, count ):
+    opcode = instr>>12
+    op1_raw = (instr>>8)&15
+    op2_raw = (instr>>4)&15
+    op1_mode = (instr>>3)&1
+    opindex = instr&7
+    x = _src( op1_raw, op1_mode, ip )
+    rb = f"r{op2_raw}"
+    used = set() if op1_mode else {op1_raw}
+    used.add(op2_raw)
+
+    if opcode==0:
+        if op1_raw==1:      # call
+            return ([ f"R[{IP}] = {_reg(op2_raw,ip)}", f"r{CT} = {(ip+1)&65535}" ], {op2_raw,CT}, {CT}, True)
+        elif op1_raw==3:    # ret
+            return ([ f"r{SP} = (r{SP}+{instr&255})&65535", f"R[{IP}] = r{CT}" ], {SP,CT}, {SP}, True)
+        # Halt and saveh stay with the interpreter.
+        return None
+    elif opcode==1:         # jp
+        a = _reg(op1_raw,ip)
+        b = _reg(op2_raw,ip)
+        return ([ f"R[{IP}] = {a} if {_cond_expr(instr&15)} else {b}" ], {op1_raw,op2_raw,FL}, set(), True)
+    elif opcode==2:         # br
+        c = (instr>>4)&255
+        delta = c if c<128 else c-256
+        return ([ f"R[{IP}] = {(ip+delta)&65535} if {_cond_expr(instr&15)} else {(ip+1)&65535}" ], {FL}, set(), True, ((ip+delta)&65535,_cond_expr(instr&15)))
+    elif opcode==4:         # st
+        lines = [
+            f"a_ = ({_reg(op2_raw,ip)}+{opindex})&65535",
+            f"M[a_] = {x}",
+            "if C[a_]:",
+            "    @WRITEBACK@",
+            f"    R[{IP}] = {(ip+1)&65535}",
+            "    I(a_)",
+            f"    return n_+{count+1}",
+        ]
+        return (lines, used, set(), False)
+    elif opcode==8:         # out
+        return ([ f"O({x},{_reg(op2_raw,ip)})" ], used, set(), False)
+
+    # Everything left writes a register, the destination of which can't be IP.
+    dst = op1_raw if opcode==9 else op2_raw
+    if dst == IP and opcode in [3,5,6,9,10,11,12]:
+        return None
+    if opcode==3:           # ld
+        line = f"{rb} = {op1_raw}" if op1_mode else f"{rb} = M[({x}+{opindex})&65535]"
+    elif opcode==5:         # add
+        line = f"{rb} = ({rb}+{x})&65535"
+    elif opcode==6:         # sub
+        line = f"{rb} = ({rb}-{x})&65535"
+    elif opcode==7:         # cmp
+        return ([
+            f"v_ = {_reg(op2_raw,ip)}-{x}",
+            f"r{FL} = (r{FL}&~15) | 1 | ( 2 if (v_==0) else 0 ) | ( 4 if (v_<0) else 0 )"
+        ], used|{FL}, {FL}, False)
+    elif opcode==9:         # const
+        return ([ f"r{op1_raw} = ((r{op1_raw}<<8)|{instr&255})&65535" ], {op1_raw}, {op1_raw}, False)
+    elif opcode==10:        # bits
+        if opindex > 4:
+            return ([ "pass" ], set(), set(), False)
+        if opindex == 3:
+            line = f"{rb} = ({rb}<<{x})&65535"
+        else:
+            line = f"{rb} {['&=','|=','^=','','>>='][opindex]} {x}"
+    elif opcode==11:        # mov
+        line = f"{rb} = {x}"
+    elif opcode==12:        # shr
+        line = f"{rb} >>= {x}"
+    else:
+        return ([ "pass" ], set(), set(), False)
+    return ([ line ], used, {op2_raw}, False)
+
+
+# Build the source for the block at start. Returns (source,end) where end
+# is the address after the last instruction in the block, or None if no
+# block can be made there.
+def translate( mem, start ):
+    body = []
+    used = set()
+    written = set()
+    ip = start
+    count = 0
+    ended = False
+    loop_cond = None
+    while count < MAX_BLOCK and ip < 65536 and not ended:
+        res = _translate_instr( mem[ip], ip, count )
+        if res == None:
+            break
+        if ip == 65535 and ( not res[3] or len(res) > 4 ):
+            # Could step off the end of memory; the interpreter reports that.
+            break
+        lines, iused, iwritten, ended = res[0:4]
+        if len(res) > 4 and res[4][0] == start:
+            # Branch back to the start: loop within the block.
+            loop_cond = res[4][1]
+            lines = [
+                f"n_ += {count+1}",
+                f"if not ({loop_cond}):",
+                f"    R[{IP}] = {ip+1}",
+                "    break",
+                f"if n_ >= {MAX_LOOP}:",
+                f"    R[{IP}] = {start}",
+                "    break",
+            ]
+        body += lines
+        used |= iused
+        written |= iwritten
+        ip += 1
+        count += 1
+    if count == 0:
+        return None
+    if not ended:
+        body.append( f"R[{IP}] = {ip}" )
+    used.discard(IP)
+    written.discard(IP)
+
+    writeback = "; ".join( [ f"R[{r}] = r{r}" for r in sorted(written) ] ) or "pass"
+    indent = "        " if loop_cond else "    "
+    src  = f"def _block_{start:04x}(R,M,C,I,O):\n"
+    src += "".join( [ f"    r{r} = R[{r}]\n" for r in sorted(used) ] )
+    src += "    n_ = 0\n"
+    if loop_cond:
+        src += "    while True:\n"
+    for line in body:
+        src += indent + line.replace("@WRITEBACK@",writeback) + "\n"
+    src += "".join( [ f"    R[{r}] = r{r}\n" for r in sorted(written) ] )
+    src += "    return n_\n" if loop_cond else f"    return {count}\n"
+    return (src, ip)
+
+# Compile the block at start. Returns (function,end) or None.
+def compile_block( mem, start ):
+    res = translate( mem, start )
+    if res == None:
+        return None
+    src, end = res
+    namespace = {}
+    exec( compile(src,f"<block {start:04x}>","exec"), namespace )
+    return (namespace[f"_block_{start:04x}"], end)
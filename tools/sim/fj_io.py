@@ -0,0 +1,97 @@
+#
+# This file is part of the Flapjack instruction level simulator
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# The IO bus. Every out instruction becomes a bus write of (data,addr),
+# data being op1 (or the 4 bit constant) and addr op2, which is passed to
+# each attached device in turn. Devices buffer what they are given and
+# only do real IO when flushed, which the machine does whenever a run
+# stops; anything else can flush on demand.
+#
+# A device has:
+#   out( data, addr )   - take a write.
+#   flush()             - push out anything buffered.
+#
+
+import sys
+
+# Console lines buffered before a flush is forced.
+_CONSOLE_BUFFER = 4096
+
+# Text screen size, as in src/textmode.sv.
+SCREEN_W = 80
+SCREEN_H = 30
+
+
+class IoBus():
+    def __init__(self, devices=None):
+        self.devices = list(devices) if devices != None else []
+
+    def attach( self, device ):
+        self.devices.append( device )
+        return device
+
+    def detach( self, device ):
+        self.devices.remove( device )
+
+    def out( self, data, addr ):
+        for device in self.devices:
+            device.out( data, addr )
+
+    def flush( self ):
+        for device in self.devices:
+            device.flush()
+
+
+# The simulator's traditional "Output data,addr" lines, one per write.
+class Console():
+    def __init__(self, outfile=None):
+        self.outfile = outfile
+        self.pending = []
+
+    def out( self, data, addr ):
+        self.pending.append( (data,addr) )
+        if len(self.pending) >= _CONSOLE_BUFFER:
+            self.flush()
+
+    def flush( self ):
+        if self.pending != []:
+            # Looked up at flush time so redirect_stdout() works.
+            outfile = self.outfile or sys.stdout
+            outfile.write( "".join( [ f"Output {d:04x},{a:02x}\n" for d,a in self.pending ] ) )
+            self.pending = []
+
+
+# The text mode display. The core drives char_x from addr[15:8], char_y
+# from addr[7:0] and char_chr from data[7:0]; textmode.sv keeps 7, 6 and
+# 8 bits of those and writes the character at y*80+x, so an x past the
+# right hand edge lands on the next line, same as the hardware.
+class TextScreen():
+    def __init__(self):
+        self.cells = bytearray(SCREEN_W*SCREEN_H)
+        self.writes = 0
+
+    def out( self, data, addr ):
+        x = (addr>>8)&127
+        y = addr&63
+        loc = (y*SCREEN_W+x)&4095
+        if loc < len(self.cells):
+            self.cells[loc] = data&255
+        self.writes += 1
+
+    def flush( self ):
+        pass
+
+    # The screen as text, one line per row with trailing blanks removed.
+    # Anything other than printable ASCII shows as a space.
+    def dump( self ):
+        rows = []
+        for y in range(0,SCREEN_H):
+            row = self.cells[y*SCREEN_W:(y+1)*SCREEN_W]
+            rows.append( "".join( [ chr(c) if 32 <= c < 127 else " " for c in row ] ).rstrip() )
+        while rows != [] and rows[-1] == "":
+            rows.pop()
+        return "\n".join(rows)+"\n"
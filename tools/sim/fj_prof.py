@@ -0,0 +1,125 @@
+#
+# This file is part of the Flapjack instruction level simulator
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Execution profile. Filled in by Machine.run(profile=...), which then
+# runs a separate counting copy of the interpreter, so an ordinary run
+# pays nothing for it. Every instruction is counted (there's no need to
+# sample when we are the machine):
+#
+#   - executions per address, and per instruction word (for per opcode
+#     totals that stay right under self-modifying code),
+#   - taken and not-taken counts per jp/br address,
+#   - instructions run under each call stack, the stack being tracked
+#     from call and ret.
+#
+# Addresses are named from the symbol map fj_as writes with -s.
+#
+
+import bisect
+
+
+# Mnemonic for an instruction word.
+def mnemonic( instr ):
+    opcode = instr>>12
+    if opcode==0:
+        return { 1:"call", 2:"saveh", 3:"ret" }.get( (instr>>8)&15, "halt" )
+    elif opcode==10:
+        return ["and","or","xor","shl","shr","bits5","bits6","bits7"][instr&7]
+    return { 1:"jp", 2:"br", 3:"ld", 4:"st", 5:"add", 6:"sub", 7:"cmp", 8:"out",
+             9:"const", 11:"mov", 12:"shr" }.get( opcode, f"op{opcode}" )
+
+
+# Read a symbol map ("address label" per line, hex addresses) into a
+# list of (address,label) sorted by address.
+def load_symbols( filename ):
+    res = []
+    with open(filename,"r") as infile:
+        for line in infile.readlines():
+            parts = line.split()
+            if len(parts) == 2:
+                res.append( (int(parts[0],16),parts[1]) )
+    res.sort()
+    return res
+
+# Names addresses from a list of (address,label) like load_symbols() gives.
+class SymbolMap():
+    def __init__(self, symbols=None):
+        self.symbols = symbols if symbols != None else []
+        self._addrs = [ s[0] for s in self.symbols ]
+
+    # Name an address as label+offset from the nearest label at or below it.
+    def name( self, addr ):
+        i = bisect.bisect_right( self._addrs, addr )-1
+        if i < 0:
+            return f"{addr:04x}"
+        base, label = self.symbols[i]
+        return label if addr == base else f"{label}+{addr-base}"
+
+
+class Profile():
+    def __init__(self, symbols=None):
+        self.addr_counts = [ 0 for i in range(0,65536) ]
+        self.word_counts = [ 0 for i in range(0,65536) ]
+        self.branches = {}      # Address -> [taken, not taken].
+        self.stacks = {}        # Tuple of function addresses -> instructions.
+        self.stack = []         # Current call stack, outermost first.
+        self.name = SymbolMap( symbols ).name
+
+    def total( self ):
+        return sum(self.addr_counts)
+
+    def opcode_counts( self ):
+        res = {}
+        for instr, n in enumerate(self.word_counts):
+            if n:
+                m = mnemonic(instr)
+                res[m] = res.get(m,0)+n
+        return res
+
+    # The hot-spot report, as text. mem is used to show what is at each
+    # address now.
+    def report( self, mem, top=40 ):
+        total = self.total()
+        if total == 0:
+            return "No instructions executed.\n"
+        out = [ f"Instructions executed: {total}", "" ]
+
+        out.append( "Hot spots:" )
+        out.append( f"{'addr':>6} {'count':>12} {'%':>6}  {'instr':<6} label" )
+        hot = sorted( [ a for a in range(0,65536) if self.addr_counts[a] ],
+                      key=lambda a:(-self.addr_counts[a],a) )
+        for a in hot[:top]:
+            n = self.addr_counts[a]
+            out.append( f"  {a:04x} {n:>12} {100*n/total:>6.2f}  {mnemonic(mem[a]):<6} {self.name(a)}" )
+        out.append( "" )
+
+        out.append( "Functions (self):" )
+        funcs = {}
+        for stack, n in self.stacks.items():
+            funcs[stack[-1]] = funcs.get(stack[-1],0)+n
+        for a, n in sorted( funcs.items(), key=lambda f:(-f[1],f[0]) )[:top]:
+            out.append( f"  {a:04x} {n:>12} {100*n/total:>6.2f}  {self.name(a)}" )
+        out.append( "" )
+
+        out.append( "Opcodes:" )
+        for m, n in sorted( self.opcode_counts().items(), key=lambda o:(-o[1],o[0]) ):
+            out.append( f"  {m:<6} {n:>12} {100*n/total:>6.2f}" )
+        out.append( "" )
+
+        out.append( "Branches:" )
+        out.append( f"{'addr':>6} {'taken':>12} {'not taken':>12}  label" )
+        for a, (t, nt) in sorted( self.branches.items(), key=lambda b:(-b[1][0]-b[1][1],b[0]) )[:top]:
+            out.append( f"  {a:04x} {t:>12} {nt:>12}  {self.name(a)}" )
+        return "\n".join(out)+"\n"
+
+    # Collapsed stacks, one "outer;inner;leaf count" line per stack, as
+    # read by flamegraph.pl and friends.
+    def write_folded( self, filename ):
+        with open(filename,"w") as outfile:
+            for stack, n in sorted( self.stacks.items() ):
+                if n:
+                    outfile.write( ";".join( [ self.name(a) for a in stack ] )+f" {n}\n" )
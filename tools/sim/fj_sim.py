@@ -1,131 +1,737 @@
-# 
+#
 # This file is part of the Flapjack instruction level simulator
 # (c) 2024 Martin Young
 # Contact: martin@endotether.org.uk
 #
 
+import os
 import sys
+import mmap
+import time
+from array import array
 
-mem = []
-regs = []
+import fj_blocks
+import fj_io
+import fj_prof
+import fj_snap
+import fj_trace
 
 IP = 15
 SP = 14
 FL = 13
 CT = 12
 
-def init():
-    global mem
-    global regs
-    mem = [ 0 for i in range(0,65536) ]
-    regs = [0 for i in range(0,16) ]
-    regs[SP] = 65535
-
-def start( infilename ):
-    init()
-    print(f"Memory words: {len(mem)}")
-    print(f"Register words: {len(regs)}")
-    with open(infilename,"r") as infile:
-        inlines = infile.readlines()
-    for n,inline in enumerate(inlines):
-        mem[n] = int(inline.strip(),16)&65535
-    work()
-
-
-def work():
-    global mem
-    global regs
-    running = True
-    while running:
-        instr = mem[regs[IP]]&65535
-        prestr = f"{regs[IP]:04x} -> {instr:04x}"
+# Reasons a run can stop.
+HALT_HALTED = "halted"          # Executed a halt (or unknown special).
+HALT_BUDGET = "budget"          # Instruction budget used up.
+HALT_TIMEOUT = "timeout"        # Wall clock deadline passed.
+HALT_OFFMEM = "offmem"          # Stepped past the last word of memory.
+
+# Instructions run between looks at the clock when a timeout is set.
+_CHECK_STEPS = 16384
+
+# Most instructions a single block call can execute, so the block engine
+# knows when to hand over to the interpreter to land exactly on a budget.
+_BLOCK_STEPS_MAX = fj_blocks.MAX_LOOP + fj_blocks.MAX_BLOCK
+
+# Marks an address whose instruction can't start a block, so is left to
+# the interpreter.
+_INTERP = False
+
+
+def _condtrue( cond, fl ):
+    cc = cond&7
+    if cond&8:
+        return (cc&(fl|1)&7)==cc
+    return (cc&((~(fl|1))&7))==cc
+
+# Condition results for every s/fff field (the low nybble of jp and br)
+# against the bottom three flag bits, so condition tests are a lookup.
+_condtab = [ tuple( _condtrue(cond,fl) for fl in range(0,8) ) for cond in range(0,16) ]
+
+
+# Build the instruction handlers for a machine, as closures over its state.
+# Each is called with the three operand fields pre-extracted by decode().
+# A handler returns None to step on to the next instruction, True if it
+# has set IP itself, or False to stop the machine.
+def _make_handlers( m ):
+    mem = m.mem
+    regs = m.regs
+    codemap = m.codemap
+    forget_code = m.forget_code
+    io = m.io
+
+    def _op_halt( a, b, c ):
+        regs[IP] = (regs[IP]+1)&65535   # IP is left pointing past the halt.
+        return False
+
+    def _op_nop( a, b, c ):
+        return None
+
+    def _op_call( a, b, c ):
+        target = regs[a]
+        regs[CT] = (regs[IP]+1)&65535
+        regs[IP] = target
+        return True
+
+    def _op_saveh( a, b, c ):
+        for n in range(0,8):
+            if (a&(1<<n))!=0:
+                addr = regs[SP]
+                mem[addr] = regs[n+8]
+                if codemap[addr]:
+                    forget_code(addr)
+                regs[SP] = (addr-1)&65535
+
+    def _op_ret( a, b, c ):
+        regs[SP] = (regs[SP]+a)&65535
+        regs[IP] = regs[CT]
+        return True
+
+    def _op_jp( a, b, c ):
+        regs[IP] = regs[a] if c[regs[FL]&7] else regs[b]
+        return True
+
+    def _op_br( a, b, c ):
+        if c[regs[FL]&7]:
+            regs[IP] = (regs[IP]+a)&65535
+            return True
+
+    def _op_ld( a, b, c ):
+        regs[b] = mem[(regs[a]+c)&65535]
+
+    def _op_ldc( a, b, c ):
+        regs[b] = a
+
+    def _op_st( a, b, c ):
+        addr = (regs[b]+c)&65535
+        mem[addr] = regs[a]
+        if codemap[addr]:
+            forget_code(addr)
+
+    def _op_stc( a, b, c ):
+        addr = (regs[b]+c)&65535
+        mem[addr] = a
+        if codemap[addr]:
+            forget_code(addr)
+
+    def _op_add( a, b, c ):
+        regs[b] = (regs[b]+regs[a])&65535
+
+    def _op_addc( a, b, c ):
+        regs[b] = (regs[b]+a)&65535
+
+    def _op_sub( a, b, c ):
+        regs[b] = (regs[b]-regs[a])&65535
+
+    def _op_subc( a, b, c ):
+        regs[b] = (regs[b]-a)&65535
+
+    def _op_cmp( a, b, c ):
+        v = regs[b] - regs[a]
+        regs[FL] = (regs[FL]&~15) | 1 | ( 2 if (v==0) else 0 ) | ( 4 if (v<0) else 0 )
+
+    def _op_cmpc( a, b, c ):
+        v = regs[b] - a
+        regs[FL] = (regs[FL]&~15) | 1 | ( 2 if (v==0) else 0 ) | ( 4 if (v<0) else 0 )
+
+    def _op_out( a, b, c ):
+        io.out( regs[a], regs[b] )
+
+    def _op_outc( a, b, c ):
+        io.out( a, regs[b] )
+
+    def _op_const( a, b, c ):
+        regs[a] = ((regs[a]<<8)|b)&65535
+
+    def _op_and( a, b, c ):
+        regs[b] &= regs[a]
+
+    def _op_andc( a, b, c ):
+        regs[b] &= a
+
+    def _op_or( a, b, c ):
+        regs[b] |= regs[a]
+
+    def _op_orc( a, b, c ):
+        regs[b] |= a
+
+    def _op_xor( a, b, c ):
+        regs[b] ^= regs[a]
+
+    def _op_xorc( a, b, c ):
+        regs[b] ^= a
+
+    def _op_shl( a, b, c ):
+        regs[b] = (regs[b]<<regs[a])&65535
+
+    def _op_shlc( a, b, c ):
+        regs[b] = (regs[b]<<a)&65535
+
+    def _op_shr( a, b, c ):
+        regs[b] >>= regs[a]
+
+    def _op_shrc( a, b, c ):
+        regs[b] >>= a
+
+    def _op_mov( a, b, c ):
+        regs[b] = regs[a]
+
+    def _op_movc( a, b, c ):
+        regs[b] = a
+
+    return {
+        "halt": _op_halt,
+        "nop": _op_nop,
+        "jp": _op_jp,
+        "br": _op_br,
+        "out": (_op_out,_op_outc),
+        "const": _op_const,
+        # Specials (opcode 0), indexed by subcode.
+        "ext": {
+            1: _op_call,
+            2: _op_saveh,
+            3: _op_ret,
+        },
+        # Format 2 opcodes, as (register form, constant form).
+        "fmt2": {
+            3: (_op_ld,_op_ldc),
+            4: (_op_st,_op_stc),
+            5: (_op_add,_op_addc),
+            6: (_op_sub,_op_subc),
+            7: (_op_cmp,_op_cmpc),
+            11: (_op_mov,_op_movc),
+            12: (_op_shr,_op_shrc),
+        },
+        # Bitwise ops (opcode 10), indexed by mode.
+        "bits": [
+            (_op_and,_op_andc),
+            (_op_or,_op_orc),
+            (_op_xor,_op_xorc),
+            (_op_shl,_op_shlc),
+            (_op_shr,_op_shrc),
+        ],
+    }
+
+
+# A single Flapjack machine: memory, registers and the caches built
+# over them. Any number can exist side by side. out instructions go to
+# the given fj_io.IoBus, by default one with just a console on it.
+class Machine():
+    def __init__(self, io=None):
+        # Machine state is held in unsigned 16 bit arrays. Every write is
+        # masked to 16 bits (the arrays reject anything wider), so reads
+        # need no masking.
+        self.mem = array('H',bytes(2*65536))
+        self.regs = array('H',bytes(2*16))
+        self.regs[SP] = 65535
+
+        # Decode and block caches are sparse, keyed by address. codemap
+        # flags every address with something cached against it, so stores
+        # only have to look at one byte to know whether to invalidate.
+        self.dcache = {}
+        self.blocks = {}        # Compiled block (or _INTERP) by start address.
+        self.bcover = {}        # Start addresses of the blocks covering each address.
+        self.bends = {}         # End address of each block, by start address.
+        self.codemap = bytearray(65536)
+
+        self.io = io if io != None else fj_io.IoBus( [ fj_io.Console() ] )
+        self.steps = 0
+        self.halt_reason = None
+        self._handlers = _make_handlers(self)
+
+    # Load an image: raw little-endian words for .bin files, otherwise the
+    # one-hex-word-per-line (Vivado .mem style) form, where "@address"
+    # lines start runs of words elsewhere.
+    def load( self, filename, base=0 ):
+        if filename[-4:] == ".bin":
+            self.load_bin( filename, base )
+        else:
+            self.load_hex( filename, base )
+
+    def load_hex( self, filename, base=0 ):
+        with open(filename,"r") as infile:
+            inlines = [ inline.strip() for inline in infile.readlines() ]
+        inlines = [ inline for inline in inlines if inline != "" ]
+        if any( [ inline[0]=='@' for inline in inlines ] ):
+            # Sparse: "@address" starts each run of words.
+            addr = base
+            run = []
+            for inline in inlines + ["@0"]:
+                if inline[0]=='@':
+                    self.load_words( run, addr )
+                    addr = base+int(inline[1:],16)
+                    run = []
+                else:
+                    run.append( int(inline,16)&65535 )
+            return
+        if all( [ len(inline)==4 for inline in inlines ] ):
+            # The usual case: convert the whole lot in one go.
+            words = array('H',bytes.fromhex("".join(inlines)))
+            if sys.byteorder == "little":
+                words.byteswap()
+        else:
+            words = array('H',[ int(inline,16)&65535 for inline in inlines ])
+        self.load_words( words, base )
+
+    # Map the file and copy it straight into memory, with no per-word work.
+    def load_bin( self, filename, base=0 ):
+        with open(filename,"rb") as infile:
+            size = os.fstat(infile.fileno()).st_size
+            nbytes = min( size&~1, 2*(65536-base) )
+            if nbytes == 0:
+                return
+            with mmap.mmap(infile.fileno(),0,access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as src, memoryview(self.mem) as dst:
+                    dst.cast('B')[2*base:2*base+nbytes] = src[0:nbytes]
+        if sys.byteorder == "big":
+            words = self.mem[base:base+nbytes//2]
+            words.byteswap()
+            self.mem[base:base+nbytes//2] = words
+        self._loaded( base, base+nbytes//2 )
+
+    def load_words( self, words, base=0 ):
+        self.mem[base:base+len(words)] = array('H',words)
+        self._loaded( base, base+len(words) )
+
+    # Drop anything cached over a freshly loaded range.
+    def _loaded( self, start, end ):
+        if self.codemap.find(1,start,end) != -1:
+            for addr in range(start,end):
+                if self.codemap[addr]:
+                    self.forget_code(addr)
+
+    def reg_dump( self ):
+        return "  ".join( [ f"{n}:{x:04x}" for n,x in enumerate(self.regs) ] )
+
+    # Turn an instruction word into a (handler,a,b,c) record.
+    def decode( self, instr ):
+        h = self._handlers
         opcode = instr>>12
         op1_raw = (instr>>8)&15
         op2_raw = (instr>>4)&15
         op1_mode = (instr>>3)&1
         opindex = instr&7
-        op1 = regs[op1_raw]&65535
-        op2 = regs[op2_raw]&65535
-        ccs = (instr>>3)&1
-        cc = (instr&7)
-        condtrue = (cc&(regs[FL]|1)&7)==cc if (ccs==1) else (cc&((~(regs[FL]|1))&7))==cc
-
-        inhibit_step = False
-        if opcode==0:       #  nop
+        if opcode==0:
+            handler = h["ext"].get(op1_raw,h["halt"])
             if op1_raw == 1:
-                # Call
-                rmask = instr&255;
-                #for b in range(0,4):
-                #    if (rmask&(1<<b))!=0:
-                #        mem[regs[SP]] = regs[b]
-                #        regs[SP] -= 1
-                regs[CT] = regs[IP]+1
-                regs[IP] = op2
-                inhibit_step = True
-            elif op1_raw == 2:
-                # Save high
-                rmask = instr&255;
-                for b in range(0,8):
-                    if (rmask&(1<<b))!=0:
-                        mem[regs[SP]] = regs[b+8]
-                        regs[SP] -= 1
-            elif op1_raw == 3:
-                # Return
-                regs[SP] = (regs[SP]&65535)+(instr&255);
-                regs[IP] = regs[CT]
-                inhibit_step = True
+                return (handler,op2_raw,0,0)
+            return (handler,instr&255,0,0)
+        elif opcode==1:
+            return (h["jp"],op1_raw,op2_raw,_condtab[instr&15])
+        elif opcode==2:
+            c = (instr>>4)&255
+            return (h["br"],c if c<128 else c-256,0,_condtab[instr&15])
+        elif opcode==8:
+            return (h["out"][op1_mode],op1_raw,op2_raw,0)
+        elif opcode==9:
+            return (h["const"],op1_raw,instr&255,0)
+        elif opcode==10:
+            if opindex >= len(h["bits"]):
+                return (h["nop"],0,0,0)
+            return (h["bits"][opindex][op1_mode],op1_raw,op2_raw,opindex)
+        elif opcode in h["fmt2"]:
+            return (h["fmt2"][opcode][op1_mode],op1_raw,op2_raw,opindex)
+        return (h["nop"],0,0,0)
+
+    # Drop everything cached against addr, because it has just been written.
+    def forget_code( self, addr ):
+        self.dcache.pop(addr,None)
+        for bstart in self.bcover.pop(addr,[]):
+            for a in range(bstart,self.bends.pop(bstart)):
+                if a != addr:
+                    self.bcover[a].remove(bstart)
+                    if not self.bcover[a]:
+                        del self.bcover[a]
+                        self.codemap[a] = 1 if a in self.dcache else 0
+            del self.blocks[bstart]
+        self.codemap[addr] = 0
+
+    # Capture the machine state. Cheap: two array copies.
+    def snapshot( self ):
+        return fj_snap.Snapshot( array('H',self.mem), array('H',self.regs), self.steps,
+                                 array('H',sorted(self.dcache)) )
+
+    # Put the machine back to a snapshot, which may have come from another
+    # machine. Cached code that still matches memory is kept, so repeated
+    # restores of the same snapshot don't throw away compiled blocks.
+    def restore( self, snap ):
+        mem = self.mem
+        smem = snap.mem
+        stale = [ a for a in self.dcache if mem[a] != smem[a] ]
+        stale += [ a for a in self.bcover if mem[a] != smem[a] ]
+        for a in stale:
+            if self.codemap[a]:
+                self.forget_code(a)
+        mem[:] = smem
+        self.regs[:] = snap.regs
+        dcache = self.dcache
+        decoded = {}
+        for a in snap.decoded:
+            if a not in dcache:
+                instr = mem[a]
+                entry = decoded.get(instr)
+                if entry is None:
+                    entry = decoded[instr] = self.decode(instr)
+                dcache[a] = entry
+                self.codemap[a] = 1
+        self.steps = snap.steps
+        self.halt_reason = None
+
+    # Compile the block starting at addr and record what it covers.
+    def _make_block( self, addr ):
+        res = fj_blocks.compile_block( self.mem, addr )
+        if res == None:
+            self.blocks[addr] = _INTERP
+            end = addr+1
+        else:
+            self.blocks[addr], end = res
+        self.bends[addr] = end
+        for a in range(addr,end):
+            self.bcover.setdefault(a,[]).append(addr)
+            self.codemap[a] = 1
+        return self.blocks[addr]
+
+    # Run until the machine stops, has executed max_steps instructions or
+    # has run for timeout seconds (where given), optionally using the block
+    # engine. Returns the total number of instructions executed; the reason
+    # for stopping is left in halt_reason. Given an fj_prof.Profile, runs
+    # the counting interpreter instead and fills it in; given an
+    # fj_trace.TraceWriter, runs the tracing interpreter and writes to it.
+    # Buffered output is flushed on the way out.
+    def run( self, max_steps=None, timeout=None, use_blocks=False, profile=None, trace=None ):
+        self.halt_reason = None
+        limit = self.steps+max_steps if max_steps != None else sys.maxsize
+        deadline = time.monotonic()+timeout if timeout != None else None
+        try:
+            if profile != None:
+                self._work_profile( limit, deadline, profile )
+            elif trace != None:
+                self._work_trace( limit, deadline, trace )
+                trace.flush()
             else:
-                running = False
-        elif opcode==1:     #  jp      Jump            Jump to O1 if flag conditions are true else to O2
-            regs[IP] = op1 if condtrue else op2
-            inhibit_step = True
-        elif opcode==2:     #  br      Branch          Jump to ip+const (const is bits 7..0 sign extended.
-            #print(f"Branch at {regs[IP]} codetrue={condtrue}, ccs={ccs}, cc={cc}")
-            if condtrue:
-                c = ((instr>>4)&255)
-                if c<128:
-                    regs[IP] = (regs[IP]+c)&65535
+                if use_blocks:
+                    self._work_blocks( limit, deadline )
+                if self.halt_reason == None:
+                    self._work( limit, deadline )
+        finally:
+            self.io.flush()
+        return self.steps
+
+    # The interpreter. The clock is only looked at between chunks of
+    # _CHECK_STEPS instructions, keeping it out of the per-step path.
+    def _work( self, limit, deadline=None ):
+        regs = self.regs
+        mem = self.mem
+        dcache = self.dcache
+        codemap = self.codemap
+        decode = self.decode
+        steps = self.steps
+        reason = None
+        while reason == None:
+            chunk_end = min( limit, steps+_CHECK_STEPS )
+            while steps < chunk_end:
+                ip = regs[IP]
+                entry = dcache.get(ip)
+                if entry is None:
+                    entry = decode(mem[ip])
+                    dcache[ip] = entry
+                    codemap[ip] = 1
+                handler, a, b, c = entry
+                res = handler(a,b,c)
+                steps += 1
+                if res is None:
+                    ip = regs[IP]+1
+                    if ip > 65535:
+                        regs[IP] = 0
+                        reason = HALT_OFFMEM
+                        break
+                    regs[IP] = ip
+                elif not res:
+                    reason = HALT_HALTED
+                    break
+                #print(f"{ip:04x} -> {mem[ip]:04x}  regs  "+self.reg_dump())
+            if reason == None:
+                if steps >= limit:
+                    reason = HALT_BUDGET
+                elif deadline != None and time.monotonic() >= deadline:
+                    reason = HALT_TIMEOUT
+        self.steps = steps
+        self.halt_reason = reason
+
+    # The interpreter again, counting into prof as it goes. Kept separate
+    # so that the counting costs nothing when not profiling.
+    def _work_profile( self, limit, deadline, prof ):
+        regs = self.regs
+        mem = self.mem
+        dcache = self.dcache
+        codemap = self.codemap
+        decode = self.decode
+        addr_counts = prof.addr_counts
+        word_counts = prof.word_counts
+        branches = prof.branches
+        stacks = prof.stacks
+        stack = prof.stack
+        if stack == []:
+            stack.append( regs[IP] )
+        key = tuple(stack)
+        steps = self.steps
+        mark = steps            # Steps already credited to a stack.
+        reason = None
+        while reason == None:
+            chunk_end = min( limit, steps+_CHECK_STEPS )
+            while steps < chunk_end:
+                ip = regs[IP]
+                instr = mem[ip]
+                addr_counts[ip] += 1
+                word_counts[instr] += 1
+                opcode = instr>>12
+                if opcode==1 or opcode==2:
+                    b = branches.get(ip)
+                    if b is None:
+                        b = branches[ip] = [0,0]
+                    b[0 if _condtab[instr&15][regs[FL]&7] else 1] += 1
+                elif opcode==0:
+                    sub = (instr>>8)&15
+                    if sub==1 or sub==3:
+                        # The call or ret itself belongs to the caller's stack.
+                        stacks[key] = stacks.get(key,0)+steps+1-mark
+                        mark = steps+1
+                        if sub==1:
+                            stack.append( regs[(instr>>4)&15] )
+                        elif len(stack) > 1:
+                            stack.pop()
+                        key = tuple(stack)
+                entry = dcache.get(ip)
+                if entry is None:
+                    entry = decode(instr)
+                    dcache[ip] = entry
+                    codemap[ip] = 1
+                handler, a, b, c = entry
+                res = handler(a,b,c)
+                steps += 1
+                if res is None:
+                    ip = regs[IP]+1
+                    if ip > 65535:
+                        regs[IP] = 0
+                        reason = HALT_OFFMEM
+                        break
+                    regs[IP] = ip
+                elif not res:
+                    reason = HALT_HALTED
+                    break
+            if reason == None:
+                if steps >= limit:
+                    reason = HALT_BUDGET
+                elif deadline != None and time.monotonic() >= deadline:
+                    reason = HALT_TIMEOUT
+        stacks[key] = stacks.get(key,0)+steps-mark
+        self.steps = steps
+        self.halt_reason = reason
+
+    # The interpreter once more, writing a trace record per instruction.
+    def _work_trace( self, limit, deadline, tw ):
+        regs = self.regs
+        mem = self.mem
+        dcache = self.dcache
+        codemap = self.codemap
+        decode = self.decode
+        effects = {}
+        steps = self.steps
+        reason = None
+        while reason == None:
+            chunk_end = min( limit, steps+_CHECK_STEPS )
+            while steps < chunk_end:
+                ip = regs[IP]
+                instr = mem[ip]
+                eff = effects.get(instr)
+                if eff is None:
+                    eff = effects[instr] = fj_trace.write_effects(instr)
+                dsts, memkind = eff
+                # Memory write addresses have to be found before the
+                # instruction changes the registers they come from.
+                if memkind == fj_trace.MEM_ST:
+                    maddrs = ( (regs[(instr>>4)&15]+(instr&7))&65535, )
+                elif memkind == fj_trace.MEM_SAVEH:
+                    sp = regs[SP]
+                    maddrs = []
+                    for n in range(0,8):
+                        if instr&(1<<n):
+                            maddrs.append( sp )
+                            sp = (sp-1)&65535
                 else:
-                    regs[IP] = (regs[IP]-(256-c))&65535
-                inhibit_step = True
-            pass
-        elif opcode==3:     #  ld      Load            Read from memory address O1 into O2
-            regs[op2_raw] = op1_raw if op1_mode else mem[(op1+opindex)&65535]
-        elif opcode==4:     #  st      Store           Write O1 into memory address O2
-            mem[(op2+opindex)&65535] =  op1_raw if op1_mode else op1
-        elif opcode==5:     #  add     Add             Add O1 to O2
-            regs[op2_raw] = (regs[op2_raw] + ( op1_raw if op1_mode else op1 ))&65535
-        elif opcode==6:     #  sub     Sub             Sub O1 from O2
-            regs[op2_raw] = (regs[op2_raw] - ( op1_raw if op1_mode else op1 ))&65535
-        elif opcode==7:     #  cmp     Compare         Compare O1 to O2
-            v = regs[op2_raw] - ( op1_raw if op1_mode else op1 )
-            regs[FL] = (regs[FL]&~15) | 1 | ( 2 if (v==0) else 0 ) | ( 4 if (v<0) else 0 )
-        elif opcode==8:     #  out     Write to IO     Write O1 into IO address O2
-            print(f"Output {op1:04x},{op2:02x}")
-        elif opcode==9:     #  const   Load 8bits      Write to O1 0x00nnn
-            regs[op1_raw] = ((op1<<8)|(instr&255))&65535
-        elif opcode==10:    #  bits    logic ops
-            if instr&7 == 0:
-                regs[op2_raw] &= op1_raw if op1_mode else op1
-            elif instr&7 == 1:
-                regs[op2_raw] |= op1_raw if op1_mode else op1
-            elif instr&7 == 2:
-                regs[op2_raw] ^= op1_raw if op1_mode else op1
-            elif instr&7 == 3:
-                #print(f"Shift {regs[op2_raw]} left by {op1_raw if op1_mode else op1}, op1_mode={op1_mode}")
-                regs[op2_raw] <<= op1_raw if op1_mode else op1
-            elif instr&7 == 4:
-                regs[op2_raw] >>= op1_raw if op1_mode else op1
-        elif opcode==11:    #  mov     Reg-reg move    Copy o1 into o2
-            regs[op2_raw] = op1_raw if op1_mode else op1
-        elif opcode==12:    #  shr     Shift right     Shift o2 right by o1 bits
-            regs[op2_raw] >>= op1_raw if op1_mode else op1
-        if not inhibit_step:
-            regs[IP] += 1
-        #print(f"{prestr}  regs  "+"  ".join( [ f"{n}:{(x&65535):04x}" for n,x in enumerate(regs) ] ))
-
-    print("Exit with:")
-    print("  ".join( [ f"{n}:{(x&65535):04x}" for n,x in enumerate(regs) ] ))
-
-start( sys.argv[1] )
+                    maddrs = ()
+                entry = dcache.get(ip)
+                if entry is None:
+                    entry = decode(instr)
+                    dcache[ip] = entry
+                    codemap[ip] = 1
+                handler, a, b, c = entry
+                res = handler(a,b,c)
+                steps += 1
+                rec = [ ip, instr, (len(dsts)<<8)|len(maddrs) ]
+                for r in dsts:
+                    rec += ( r, regs[r] )
+                for addr in maddrs:
+                    rec += ( addr, mem[addr] )
+                buf = tw.buf
+                buf.extend( rec )
+                if len(buf) >= fj_trace._WRITE_WORDS:
+                    tw.flush()
+                if res is None:
+                    ip = regs[IP]+1
+                    if ip > 65535:
+                        regs[IP] = 0
+                        reason = HALT_OFFMEM
+                        break
+                    regs[IP] = ip
+                elif not res:
+                    reason = HALT_HALTED
+                    break
+            if reason == None:
+                if steps >= limit:
+                    reason = HALT_BUDGET
+                elif deadline != None and time.monotonic() >= deadline:
+                    reason = HALT_TIMEOUT
+        self.steps = steps
+        self.halt_reason = reason
+
+    # The block engine. Runs translated blocks while it can, leaving the
+    # odd instruction that can't be translated to the interpreter. Returns
+    # with halt_reason unset when too little budget is left for a whole
+    # block, for the interpreter to finish off.
+    def _work_blocks( self, limit, deadline=None ):
+        regs = self.regs
+        mem = self.mem
+        blocks = self.blocks
+        codemap = self.codemap
+        forget_code = self.forget_code
+        out = self.io.out
+        make_block = self._make_block
+        steps = self.steps
+        last_block_start = limit-_BLOCK_STEPS_MAX
+        while steps <= last_block_start:
+            chunk_end = min( last_block_start, steps+_CHECK_STEPS )
+            while steps <= chunk_end:
+                ip = regs[IP]
+                blk = blocks.get(ip)
+                if blk is None:
+                    blk = make_block(ip)
+                if blk:
+                    steps += blk(regs,mem,codemap,forget_code,out)
+                    continue
+                self.steps = steps
+                self._work( steps+1 )
+                steps = self.steps
+                if self.halt_reason != HALT_BUDGET:
+                    return
+                self.halt_reason = None
+            if deadline != None and time.monotonic() >= deadline:
+                self.halt_reason = HALT_TIMEOUT
+                break
+        self.steps = steps
+
+
+# Run forward from a snapshot once per patch, yielding the machine after
+# each run. A patch is a dict with any of:
+#   "mem":  list of (address,[words]) to write into memory,
+#   "regs": dict of register number -> value.
+# The same machine is used throughout (so look at it before asking for
+# the next), which keeps compiled blocks over the shared code.
+def run_patches( snap, patches, max_steps=None, timeout=None, use_blocks=True, io=None ):
+    m = Machine( io )
+    for patch in patches:
+        m.restore( snap )
+        for addr, words in patch.get("mem",[]):
+            m.load_words( words, addr )
+        for reg, val in patch.get("regs",{}).items():
+            m.regs[reg] = val&65535
+        m.run( max_steps, timeout, use_blocks )
+        yield m
+
+# Where a symbol map would be for an image: alongside it, as written by
+# fj_as -s.
+def default_symfile( infilename ):
+    base = os.path.splitext(infilename)[0]
+    return base+".sym" if os.path.exists(base+".sym") else None
+
+def start( infilename, use_blocks=False, max_steps=None, timeout=None, profname=None, symfile=None, screen=False, snapname=None, tracename=None ):
+    # Headless display: the text screen replaces the console, and is
+    # dumped once the run stops.
+    tscreen = fj_io.TextScreen() if screen else None
+    m = Machine( fj_io.IoBus( [ tscreen ] ) if screen else None )
+    print(f"Memory words: {len(m.mem)}")
+    print(f"Register words: {len(m.regs)}")
+    if infilename[-5:] == ".snap":
+        m.restore( fj_snap.load_snapshot(infilename) )
+    else:
+        m.load( infilename )
+    prof = None
+    if profname != None:
+        symfile = symfile or default_symfile(infilename)
+        prof = fj_prof.Profile( fj_prof.load_symbols(symfile) if symfile else None )
+    tw = fj_trace.TraceWriter(tracename) if tracename != None else None
+    m.run( max_steps, timeout, use_blocks, prof, tw )
+    if tw != None:
+        tw.close()
+    print(f"Exit ({m.halt_reason} after {m.steps} instructions) with:")
+    print(m.reg_dump())
+    if snapname != None:
+        fj_snap.save_snapshot( m.snapshot(), snapname )
+        print(f"Snapshot written to {snapname}")
+    if tscreen != None:
+        print(f"Screen ({tscreen.writes} writes):")
+        print(tscreen.dump(),end="")
+    if prof != None:
+        with open(profname+".prof","w") as outfile:
+            outfile.write( prof.report(m.mem) )
+        prof.write_folded( profname+".folded" )
+        print(f"Profile written to {profname}.prof and {profname}.folded")
+    return m
+
+def main():
+    use_blocks = False
+    max_steps = None
+    timeout = None
+    profname = None
+    symfile = None
+    screen = False
+    snapname = None
+    tracename = None
+    filenames = []
+    args = sys.argv[1:]
+    while args != []:
+        arg = args.pop(0)
+        if arg in ["-n","-t","-p","-s","-w","-x"]:
+            if args == []:
+                print(f"Flag {arg} needs a value. Exiting.")
+                exit(1)
+            val = args.pop(0)
+            if arg == "-n":
+                max_steps = int(val,0)
+            elif arg == "-t":
+                timeout = float(val)
+            elif arg == "-p":
+                profname = val
+            elif arg == "-w":
+                snapname = val
+            elif arg == "-x":
+                tracename = val
+            else:
+                symfile = val
+        elif arg == "-b":
+            use_blocks = True
+        elif arg == "-d":
+            screen = True
+        elif arg[0]=='-':
+            print(f"Unknown flag {arg}. Exiting.")
+            exit(1)
+        else:
+            filenames.append( arg )
+    if len(filenames) != 1:
+        print("Usage: fj_sim.py [-b] [-d] [-n max_steps] [-t timeout_secs] [-p profile_name [-s symbols.sym]] [-w out.snap] [-x out.trace] <image|in.snap>")
+        exit(1)
+    start( filenames[0], use_blocks, max_steps, timeout, profname, symfile, screen, snapname, tracename )
 
+if __name__ == '__main__':
+    main()
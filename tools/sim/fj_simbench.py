@@ -0,0 +1,190 @@
+#
+# This file is part of the Flapjack instruction level simulator
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Simulator benchmark. Runs a program to completion with the
+# simulator (both interpreter and block engine) and with the original
+# decode-every-step loop, and reports instructions per second for each.
+#
+# Usage: fj_simbench.py [image.o]
+#
+# With no image, a built-in counting loop is assembled and used.
+# Any image given must halt.
+#
+
+import io
+import os
+import sys
+import time
+import contextlib
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),"..","assem"))
+
+import fj_sim
+from fj_as import do_assembly
+
+_bench_source = """
+.org 0
+    mov     0, r1
+    const   hi(3000), r2
+    const   lo(3000), r2
+    const   hi(scratch), r5
+    const   lo(scratch), r5
+    const   hi(leaf), r7
+    const   lo(leaf), r7
+outer:
+    mov     15, r3
+inner:
+    add     r3, r1
+    xor     5, r1
+    st      r1, r5[0]
+    ld      r5[0], r4
+    add     r4, r6
+    sub     1, r3
+    cmp     0, r3
+    br.E    inner
+    call    r7
+    sub     1, r2
+    cmp     0, r2
+    br.E    outer
+    halt
+leaf:
+    add     1, r8
+    ret     0
+scratch:
+    .word   0
+"""
+
+
+# The simulator's original main loop, decoding every instruction on
+# every step. Kept verbatim (bar the step count) as the baseline.
+def _baseline_work( mem, regs ):
+    IP = fj_sim.IP
+    SP = fj_sim.SP
+    FL = fj_sim.FL
+    CT = fj_sim.CT
+    steps = 0
+    running = True
+    while running:
+        instr = mem[regs[IP]]&65535
+        opcode = instr>>12
+        op1_raw = (instr>>8)&15
+        op2_raw = (instr>>4)&15
+        op1_mode = (instr>>3)&1
+        opindex = instr&7
+        op1 = regs[op1_raw]&65535
+        op2 = regs[op2_raw]&65535
+        ccs = (instr>>3)&1
+        cc = (instr&7)
+        condtrue = (cc&(regs[FL]|1)&7)==cc if (ccs==1) else (cc&((~(regs[FL]|1))&7))==cc
+
+        inhibit_step = False
+        if opcode==0:
+            if op1_raw == 1:
+                regs[CT] = regs[IP]+1
+                regs[IP] = op2
+                inhibit_step = True
+            elif op1_raw == 2:
+                rmask = instr&255;
+                for b in range(0,8):
+                    if (rmask&(1<<b))!=0:
+                        mem[regs[SP]] = regs[b+8]
+                        regs[SP] -= 1
+            elif op1_raw == 3:
+                regs[SP] = (regs[SP]&65535)+(instr&255);
+                regs[IP] = regs[CT]
+                inhibit_step = True
+            else:
+                running = False
+        elif opcode==1:
+            regs[IP] = op1 if condtrue else op2
+            inhibit_step = True
+        elif opcode==2:
+            if condtrue:
+                c = ((instr>>4)&255)
+                if c<128:
+                    regs[IP] = (regs[IP]+c)&65535
+                else:
+                    regs[IP] = (regs[IP]-(256-c))&65535
+                inhibit_step = True
+        elif opcode==3:
+            regs[op2_raw] = op1_raw if op1_mode else mem[(op1+opindex)&65535]
+        elif opcode==4:
+            mem[(op2+opindex)&65535] =  op1_raw if op1_mode else op1
+        elif opcode==5:
+            regs[op2_raw] = (regs[op2_raw] + ( op1_raw if op1_mode else op1 ))&65535
+        elif opcode==6:
+            regs[op2_raw] = (regs[op2_raw] - ( op1_raw if op1_mode else op1 ))&65535
+        elif opcode==7:
+            v = regs[op2_raw] - ( op1_raw if op1_mode else op1 )
+            regs[FL] = (regs[FL]&~15) | 1 | ( 2 if (v==0) else 0 ) | ( 4 if (v<0) else 0 )
+        elif opcode==8:
+            print(f"Output {op1:04x},{op2:02x}")
+        elif opcode==9:
+            regs[op1_raw] = ((op1<<8)|(instr&255))&65535
+        elif opcode==10:
+            if instr&7 == 0:
+                regs[op2_raw] &= op1_raw if op1_mode else op1
+            elif instr&7 == 1:
+                regs[op2_raw] |= op1_raw if op1_mode else op1
+            elif instr&7 == 2:
+                regs[op2_raw] ^= op1_raw if op1_mode else op1
+            elif instr&7 == 3:
+                regs[op2_raw] <<= op1_raw if op1_mode else op1
+            elif instr&7 == 4:
+                regs[op2_raw] >>= op1_raw if op1_mode else op1
+        elif opcode==11:
+            regs[op2_raw] = op1_raw if op1_mode else op1
+        elif opcode==12:
+            regs[op2_raw] >>= op1_raw if op1_mode else op1
+        if not inhibit_step:
+            regs[IP] += 1
+        steps += 1
+    return steps
+
+
+def load_image( filename ):
+    with open(filename,"r") as infile:
+        return [ int(inline.strip(),16)&65535 for inline in infile.readlines() ]
+
+def time_baseline( image ):
+    mem = image + [ 0 for i in range(len(image),65536) ]
+    regs = [ 0 for i in range(0,16) ]
+    regs[fj_sim.SP] = 65535
+    start = time.perf_counter()
+    steps = _baseline_work( mem, regs )
+    return steps, time.perf_counter()-start, [ x&65535 for x in regs ]
+
+def time_sim( image, use_blocks ):
+    m = fj_sim.Machine()
+    m.load_words( image )
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        steps = m.run( use_blocks=use_blocks )
+    return steps, time.perf_counter()-start, list(m.regs)
+
+def main():
+    if len(sys.argv) > 1:
+        image = load_image(sys.argv[1])
+    else:
+        image = do_assembly( "<bench>", _bench_source.split("\n") )
+
+    # Best of a few runs each, to keep the noise down.
+    results = [
+        ("baseline",)+min( [ time_baseline(image) for i in range(0,3) ], key=lambda r:r[1] ),
+        ("decode cache",)+min( [ time_sim(image,False) for i in range(0,3) ], key=lambda r:r[1] ),
+        ("block engine",)+min( [ time_sim(image,True) for i in range(0,3) ], key=lambda r:r[1] ),
+    ]
+    base_ips = results[0][1]/results[0][2]
+    for name, steps, secs, final_regs in results:
+        ips = steps/secs
+        print(f"{name:>14}: {steps} instructions in {secs:.3f}s, {ips/1e6:.3f} MIPS ({ips/base_ips:.2f}x)")
+    if any( r[3] != results[0][3] for r in results ):
+        print("MISMATCH: final register state differs between runs.")
+        exit(1)
+
+if __name__ == '__main__':
+    main()
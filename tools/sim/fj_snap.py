@@ -0,0 +1,96 @@
+#
+# This file is part of the Flapjack instruction level simulator
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Machine snapshots. A snapshot is the memory, registers, instruction
+# count and the set of addresses in the decode cache, taken with
+# Machine.snapshot() and put back with Machine.restore().
+#
+# Snapshot files only hold the 256 word pages of memory that aren't all
+# zero:
+#
+#   "FJSNAP01"
+#   16 registers                 16 bit LE
+#   instruction count            64 bit LE
+#   page map                     32 bytes, bit n%8 of byte n//8 set if
+#                                page n is present
+#   present pages, in order      256 16 bit LE words each
+#   decoded address count        32 bit LE
+#   decoded addresses            16 bit LE each
+#
+
+import sys
+import struct
+from array import array
+
+MAGIC = b"FJSNAP01"
+PAGE_WORDS = 256
+PAGES = 65536//PAGE_WORDS
+
+_ZERO_PAGE = bytes(2*PAGE_WORDS)
+
+
+class Snapshot():
+    def __init__(self, mem, regs, steps, decoded):
+        # Held as arrays, which must not be changed once in a snapshot.
+        self.mem = mem              # array('H') of 65536 words.
+        self.regs = regs            # array('H') of 16 words.
+        self.steps = steps
+        self.decoded = decoded      # array('H') of decoded addresses.
+
+
+def _to_le( words ):
+    if sys.byteorder == "big":
+        words = array('H',words)
+        words.byteswap()
+    return words.tobytes()
+
+def _from_le( data ):
+    words = array('H',data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+def save_snapshot( snap, filename ):
+    mem = _to_le( snap.mem )
+    pmap = bytearray(PAGES//8)
+    pages = []
+    for n in range(0,PAGES):
+        page = mem[2*PAGE_WORDS*n:2*PAGE_WORDS*(n+1)]
+        if page != _ZERO_PAGE:
+            pmap[n//8] |= 1<<(n%8)
+            pages.append( page )
+    with open(filename,"wb") as outfile:
+        outfile.write( MAGIC )
+        outfile.write( _to_le( snap.regs ) )
+        outfile.write( struct.pack("<Q",snap.steps) )
+        outfile.write( pmap )
+        outfile.write( b"".join(pages) )
+        outfile.write( struct.pack("<I",len(snap.decoded)) )
+        outfile.write( _to_le( snap.decoded ) )
+
+def load_snapshot( filename ):
+    with open(filename,"rb") as infile:
+        data = infile.read()
+    if data[0:8] != MAGIC:
+        raise ValueError(f"'{filename}' is not a snapshot")
+    pos = 8
+    regs = _from_le( data[pos:pos+32] )
+    pos += 32
+    steps = struct.unpack_from("<Q",data,pos)[0]
+    pos += 8
+    pmap = data[pos:pos+PAGES//8]
+    pos += PAGES//8
+    mem = bytearray(2*65536)
+    for n in range(0,PAGES):
+        if pmap[n//8]&(1<<(n%8)):
+            mem[2*PAGE_WORDS*n:2*PAGE_WORDS*(n+1)] = data[pos:pos+2*PAGE_WORDS]
+            pos += 2*PAGE_WORDS
+    mem = _from_le( mem )
+    count = struct.unpack_from("<I",data,pos)[0]
+    pos += 4
+    decoded = _from_le( data[pos:pos+2*count] )
+    return Snapshot( mem, regs, steps, decoded )
@@ -0,0 +1,258 @@
+#
+# This file is part of the Flapjack instruction level simulator
+# (c) 2024 Martin Young
+# Contact: martin@endotether.org.uk
+#
+
+#
+# Lockstep traces. One record per instruction executed, giving what the
+# instruction did, so two implementations of the ISA (fj_sim and the core
+# under Verilator, say) can be run side by side and compared.
+#
+# A trace file is "FJTRACE1" followed by records, each a run of 16 bit
+# little-endian words:
+#
+#   ip
+#   instruction word
+#   (register writes<<8) | memory writes
+#   register, value             for each register write
+#   address, value              for each memory write
+#
+# Register writes are every register the instruction writes other than
+# IP (the next record's ip covers that), in register order, whether or
+# not the value changed. Memory writes are in the order made.
+#
+# Usage: fj_trace.py [-s symbols.sym] cmp <a.trace> <b.trace>
+#        fj_trace.py [-s symbols.sym] dump <a.trace> [count]
+#
+# cmp exits non-zero at the first record that differs, reporting it and
+# the records leading up to it. With -s, addresses are also given as
+# label+offset from a symbol map written by fj_as -s.
+#
+
+import sys
+import itertools
+from array import array
+from collections import deque
+
+from fj_prof import SymbolMap, load_symbols
+
+MAGIC = b"FJTRACE1"
+
+IP = 15
+SP = 14
+FL = 13
+CT = 12
+
+# Words buffered by a writer before going to the file.
+_WRITE_WORDS = 65536
+
+# Bytes read at a time by a reader.
+_READ_BYTES = 1<<20
+
+# Records of context shown before a divergence.
+_CONTEXT = 8
+
+# Memory write kinds.
+MEM_NONE = 0
+MEM_ST = 1
+MEM_SAVEH = 2
+
+
+# The registers an instruction writes (bar IP), and how it writes memory.
+def write_effects( instr ):
+    opcode = instr>>12
+    op1_raw = (instr>>8)&15
+    op2_raw = (instr>>4)&15
+    if opcode==0:
+        if op1_raw==1:
+            return ((CT,),MEM_NONE)
+        elif op1_raw==2:
+            return ((SP,),MEM_SAVEH)
+        elif op1_raw==3:
+            return ((SP,),MEM_NONE)
+        return ((),MEM_NONE)
+    elif opcode==4:
+        return ((),MEM_ST)
+    elif opcode==7:
+        return ((FL,),MEM_NONE)
+    elif opcode==9:
+        dst = op1_raw
+    elif opcode==10 and (instr&7) > 4:
+        return ((),MEM_NONE)
+    elif opcode in [3,5,6,10,11,12]:
+        dst = op2_raw
+    else:
+        return ((),MEM_NONE)
+    return (() if dst==IP else (dst,),MEM_NONE)
+
+
+class TraceWriter():
+    def __init__(self, filename):
+        self.outfile = open(filename,"wb")
+        self.outfile.write( MAGIC )
+        self.buf = array('H')
+
+    def flush( self ):
+        if sys.byteorder == "big":
+            self.buf.byteswap()
+        self.buf.tofile( self.outfile )
+        self.buf = array('H')
+        self.outfile.flush()
+
+    def close( self ):
+        self.flush()
+        self.outfile.close()
+
+
+# Read a trace a chunk at a time, starting start bytes into the records.
+def _read_chunks( filename, start=0 ):
+    with open(filename,"rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"'{filename}' is not a trace")
+        infile.seek( len(MAGIC)+start )
+        while True:
+            data = infile.read(_READ_BYTES)
+            if data == b"":
+                break
+            yield data
+
+# The same, as arrays of words.
+def _read_words( filename, start=0 ):
+    for data in _read_chunks( filename, start ):
+        words = array('H',data[0:len(data)&~1])
+        if sys.byteorder == "big":
+            words.byteswap()
+        yield words
+
+# Yield the records of a trace as (ip,instr,regwrites,memwrites), the
+# writes being tuples of (register,value) and (address,value) pairs,
+# starting start bytes into the records. Reads a chunk at a time, so
+# memory use doesn't grow with the trace.
+def read_trace( filename, start=0 ):
+    words = array('H')
+    pos = 0
+    for more in _read_words( filename, start ):
+        words = words[pos:]+more
+        pos = 0
+        end = len(words)
+        while pos+3 <= end:
+            counts = words[pos+2]
+            nreg = counts>>8
+            nmem = counts&255
+            rend = pos+3+2*nreg
+            mend = rend+2*nmem
+            if mend > end:
+                break
+            regw = tuple( zip( words[pos+3:rend:2], words[pos+4:rend:2] ) )
+            memw = tuple( zip( words[rend:mend:2], words[rend+1:mend:2] ) )
+            yield (words[pos],words[pos+1],regw,memw)
+            pos = mend
+    if pos != len(words):
+        raise ValueError(f"'{filename}' ends part way through a record")
+
+
+def format_record( n, rec, syms=None ):
+    ip, instr, regw, memw = rec
+    res = f"{n:>10}  {ip:04x}: {instr:04x}"
+    if syms != None:
+        res += f"  <{syms.name(ip)}>"
+    res += "".join( [ f"  r{r}={v:04x}" for r,v in regw ] )
+    res += "".join( [ f"  [{a:04x}]={v:04x}" for a,v in memw ] )
+    return res
+
+
+# Byte offset into the records of the first difference between two
+# traces, or None if they are the same. Whole chunks are compared at a
+# time, and a differing chunk is bisected.
+def _first_difference( aname, bname ):
+    off = 0
+    for a, b in itertools.zip_longest( _read_chunks(aname), _read_chunks(bname), fillvalue=b"" ):
+        if a != b:
+            lo = 0
+            hi = min( len(a), len(b) )
+            while lo < hi:
+                mid = (lo+hi)//2
+                if a[lo:mid+1] == b[lo:mid+1]:
+                    lo = mid+1
+                else:
+                    hi = mid
+            return off+lo
+        off += len(a)
+    return None
+
+# Find the record holding byte offset stop. Returns its number and the
+# byte offsets of it and the records before it (up to _CONTEXT of them).
+# Past the end, the record number is the record count.
+def _locate( filename, stop ):
+    starts = deque( maxlen=_CONTEXT+1 )
+    n = 0
+    base = 0
+    words = array('H')
+    pos = 0
+    for more in _read_words( filename ):
+        base += 2*pos
+        words = words[pos:]+more
+        pos = 0
+        end = len(words)
+        while pos+3 <= end:
+            counts = words[pos+2]
+            mend = pos+3+2*((counts>>8)+(counts&255))
+            if mend > end:
+                break
+            starts.append( base+2*pos )
+            if base+2*mend > stop:
+                return (n,list(starts))
+            pos = mend
+            n += 1
+    starts.append( base+2*pos )
+    return (n,list(starts))
+
+# Compare two traces. Returns None if they match, otherwise (record
+# number, record from a, record from b, preceding records), with None
+# standing in for the record of a trace that has ended. Only the region
+# around the divergence is decoded into records.
+def compare( aname, bname ):
+    stop = _first_difference( aname, bname )
+    if stop == None:
+        return None
+    n, starts = _locate( aname, stop )
+    context = list( zip( range(n-len(starts)+1,n), itertools.islice( read_trace(aname,starts[0]), len(starts)-1 ) ) )
+    arec = next( read_trace(aname,starts[-1]), None )
+    brec = next( read_trace(bname,starts[-1]), None )
+    return (n,arec,brec,context)
+
+
+def main():
+    args = sys.argv[1:]
+    syms = None
+    if args[0:1] == ["-s"]:
+        if len(args) < 2:
+            print("Flag -s needs a value. Exiting.")
+            exit(1)
+        syms = SymbolMap( load_symbols(args[1]) )
+        args = args[2:]
+    if len(args) == 3 and args[0] == "cmp":
+        res = compare( args[1], args[2] )
+        if res == None:
+            print("Traces match.")
+            exit(0)
+        n, arec, brec, context = res
+        print(f"Traces diverge at record {n}:")
+        for cn, crec in context:
+            print("  "+format_record(cn,crec,syms))
+        print(f"< {format_record(n,arec,syms) if arec else '(end of trace)'}")
+        print(f"> {format_record(n,brec,syms) if brec else '(end of trace)'}")
+        exit(1)
+    elif len(args) in [2,3] and args[0] == "dump":
+        count = int(args[2],0) if len(args) == 3 else None
+        for n, rec in enumerate( read_trace(args[1]) ):
+            if n == count:
+                break
+            print(format_record(n,rec,syms))
+        exit(0)
+    print("Usage: fj_trace.py [-s symbols.sym] cmp <a.trace> <b.trace> | dump <a.trace> [count]")
+    exit(1)
+
+if __name__ == '__main__':
+    main()